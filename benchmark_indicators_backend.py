@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Dec 11 14:20:08 2023
+
+@author: Tuni
+"""
+
+# this file compares the pandas backend of the indicator calculation (star_schema.query_meals + indicators.compute_indicators)
+# with the SQL backend that calculates the indicators with DuckDB straight from the Parquet tables (see indicators_sql.py)
+# it writes a synthetic star schema into a temporary folder, so it can be run without the raw data
+# ATTENTION: both backends need to produce the same indicators as the old groupby calculation of extract_metrics.py, the benchmark
+# fails otherwise (parity check)
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import indicators
+import indicators_sql
+import star_schema
+import storage
+from benchmarking import best_time, synthetic_meal_notes, synthetic_prices
+from note_sets import NoteSets
+
+# size of the synthetic data: number of meals, number of canteens, average number of notes per meal
+N_MEALS = 2_000_000
+N_CANTEENS = 400
+NOTES_PER_MEAL = 2.5
+
+# notes and super categories of the synthetic meals (the first notes are the common ones)
+NOTES = ["vegetarisch", "vegan", "Schwein", "Rind", "Alkohol", "Geflügel", "Fisch", "ohne Fleisch", "Sellerie", "Senf"]
+SUPER_CATEGORIES = ["main_dish", "side_dish", "baked_goods", "dessert", "salad", None]
+
+
+# synthetic star schema of the same shape as the one written by notes_cleanup.py
+def create_data(base_dir, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # canteens and days are only referenced by their keys, but they need to exist for the query API
+    canteen_df = pd.DataFrame({"canteen_name": [f"Mensa {i}" for i in range(N_CANTEENS)]}, index=pd.Index(np.arange(N_CANTEENS), name="canteen_id"))
+    storage.write_table(canteen_df, "canteens_cleaned", base_dir=base_dir)
+    days_df = pd.DataFrame({"canteen_id": [0], "date_correct": pd.to_datetime(["2012-08-01"])}, index=pd.Index([0], name="days_id"))
+    storage.write_table(days_df, "days_cleaned", base_dir=base_dir)
+
+    meal_names = np.array(["Spaghetti Bolognese", "Vollkornbrötchen", "Gemüsecurry", "Apfelstrudel", "Vollkornnudeln mit Pesto", None], dtype=object)
+    categories = np.array([f"Kategorie {i}" for i in range(40)], dtype=object)
+    category_codes = rng.integers(0, len(categories), N_MEALS)
+    meals_df = pd.DataFrame({"meal_name": meal_names[rng.integers(0, len(meal_names), N_MEALS)],
+                             "meal_category": categories[category_codes],
+                             "meal_super_category": np.array(SUPER_CATEGORIES, dtype=object)[category_codes % len(SUPER_CATEGORIES)],
+                             "meal_price_student": synthetic_prices(rng, N_MEALS, 0.1),
+                             "date_correct": pd.to_datetime("2012-08-01") + pd.to_timedelta(rng.integers(0, 4000, N_MEALS), unit="D"),
+                             "day_id": np.zeros(N_MEALS, dtype="int64"),
+                             "canteen_id": rng.integers(0, N_CANTEENS, N_MEALS)},
+                            index=pd.Index(np.arange(N_MEALS), name="meal_id"))
+
+    mapper_df = synthetic_meal_notes(rng, int(N_MEALS * NOTES_PER_MEAL), N_MEALS, len(NOTES) - 1)
+    note_sets = NoteSets.from_pairs(meals_df.index, mapper_df["meal_id"].to_numpy(), mapper_df["note_id"].to_numpy())
+
+    vocabulary_df = pd.DataFrame({"notes_name": NOTES, "is_common": np.arange(len(NOTES)) < 8}, index=pd.Index(np.arange(len(NOTES)), name="note_id"))
+    counts = note_sets.note_lists(vocabulary_df["notes_name"])
+    meals_df["notes_count"] = counts["notes_count"].to_numpy()
+    meals_df["notes_count_90"] = note_sets.subset(vocabulary_df.index[vocabulary_df["is_common"]]).note_lists(vocabulary_df["notes_name"])["notes_count"].to_numpy()
+
+    star_schema.build_star_schema(meals_df, note_sets, vocabulary_df, base_dir=base_dir)
+
+
+# old approach of extract_metrics.py: one groupby per indicator (count() of meal names, sum of flags, mean of prices per day,
+# then mean per month), used as reference for both backends
+# ATTENTION: flags are read from the star schema instead of matching notes_list_90 again (same rules, see meal_flags.py)
+def indicators_with_groupby(base_dir):
+    meals_df = star_schema.query_meals(indicators.meal_columns(), base_dir=base_dir)
+    meals_df["year"] = meals_df["date_correct"].dt.year
+    meals_df["month"] = meals_df["date_correct"].dt.month
+    keys = ["canteen_id", "year", "month"]
+
+    def monthly_mean(daily, columns):
+        return daily.groupby(by=keys)[columns].mean().reset_index()
+
+    not_baked = meals_df[meals_df["meal_super_category"] != "baked_goods"]
+    main_dishes = meals_df[meals_df["meal_super_category"] == "main_dish"]
+    not_baked_or_dessert = meals_df[~meals_df["meal_super_category"].isin(["baked_goods", "dessert"])]
+
+    daily = not_baked.groupby(by=keys + ["date_correct"]).agg(avg_count_meals=("meal_name", "count")).reset_index()
+    results = [monthly_mean(daily, ["avg_count_meals"])]
+    daily = main_dishes.groupby(by=keys + ["date_correct"]).agg(avg_count_main_dishes=("meal_name", "count"),
+                                                                  meal_price_student=("meal_price_student", "mean")).reset_index()
+    results.append(monthly_mean(daily, ["avg_count_main_dishes", "meal_price_student"]))
+
+    for flag, population, name in [("is_vegetarian", meals_df, "vegetarian"), ("is_vegan", meals_df, "vegan"),
+                                   ("contains_whole_grain", not_baked_or_dessert, "whole_grain")]:
+        daily = population.groupby(by=keys + ["date_correct"]).agg(count=(flag, "sum"), total_count=("meal_name", "count")).reset_index()
+        daily[f"avg_count_{name}"] = daily["count"].astype("float64")
+        daily[f"avg_percent_{name}"] = daily["count"] / daily["total_count"] * 100
+        results.append(monthly_mean(daily, [f"avg_count_{name}", f"avg_percent_{name}"]))
+
+    # one row per canteen and month with meals, same as indicators.compute_indicators
+    indicators_df = meals_df[keys].drop_duplicates()
+    for result in results:
+        indicators_df = pd.merge(left=indicators_df, right=result, how="left", on=keys)
+    return indicators_df[keys + list(indicators.INDICATORS)].sort_values(by=keys, ignore_index=True)
+
+
+# pandas backend: read the needed features through the query API, then calculate the indicators in memory
+def indicators_with_pandas(base_dir):
+    meals_df = star_schema.query_meals(indicators.meal_columns(), base_dir=base_dir)
+    return indicators.compute_indicators(meals_df)
+
+
+# SQL backend: scan and aggregate the Parquet tables with DuckDB
+def indicators_with_sql(base_dir, threads=None):
+    return indicators_sql.compute_indicators(base_dir=base_dir, threads=threads)
+
+
+if __name__ == "__main__":
+    if not indicators_sql.available():
+        raise SystemExit("duckdb is not installed, the SQL backend can't be benchmarked (pip install duckdb)")
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        create_data(base_dir)
+        print(f"{N_MEALS} meals, {N_CANTEENS} canteens, {len(indicators.INDICATORS)} indicators")
+
+        groupby_time, reference = best_time(indicators_with_groupby, base_dir)
+        pandas_time, expected = best_time(indicators_with_pandas, base_dir)
+        sql_time_single, result_single = best_time(indicators_with_sql, base_dir, 1)
+        sql_time, result = best_time(indicators_with_sql, base_dir)
+
+        # parity check: both backends need to produce the same indicators as the old calculation (up to floating point noise of the sums)
+        # ATTENTION: compare every backend with the old calculation, not only the backends with each other (they share the counter plan)
+        pd.testing.assert_frame_equal(expected, reference, check_dtype=False, rtol=1e-9)
+        pd.testing.assert_frame_equal(result_single, reference, check_dtype=False, rtol=1e-9)
+        pd.testing.assert_frame_equal(result, reference, check_dtype=False, rtol=1e-9)
+
+        print(f"groupby per indicator: {groupby_time:.2f} s")
+        print(f"pandas:                {pandas_time:.2f} s")
+        print(f"SQL (1 thread):        {sql_time_single:.2f} s")
+        print(f"SQL ({os.cpu_count()} threads):      {sql_time:.2f} s")
+        print(f"speedup:               {pandas_time / sql_time:.1f}x")
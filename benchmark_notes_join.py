@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Nov 29 11:05:32 2023
+
+@author: Tuni
+"""
+
+# this file compares the old notes join of notes_cleanup.py (merge + groupby with a lambda per meal) with the vectorized
+# note lists built from note sets (see note_sets.py)
+# it uses synthetic data of the same shape as meals_notes.csv, so it can be run without the raw data
+
+import numpy as np
+import pandas as pd
+
+from benchmarking import best_time, synthetic_meal_notes
+from note_sets import NoteSets
+
+# size of the synthetic data: number of meals, number of distinct notes, average number of notes per meal
+N_MEALS = 1_000_000
+N_NOTES = 300
+NOTES_PER_MEAL = 2.5
+
+
+# synthetic meals, notes and mapper (some meals without notes, some mapper rows of unknown meals and notes)
+def create_data(seed=0):
+    rng = np.random.default_rng(seed)
+    meals_df = pd.DataFrame({"meal_id": np.arange(N_MEALS), "meal_name": "Spaghetti"}).set_index("meal_id")
+    notes_df = pd.DataFrame({"notes_name": [f"note {i}" for i in range(N_NOTES)]}, index=pd.Index(np.arange(N_NOTES), name="notes_id"))
+
+    mapper_df = synthetic_meal_notes(rng, int(N_MEALS * NOTES_PER_MEAL), int(N_MEALS * 1.1), int(N_NOTES * 1.05))
+    return meals_df, notes_df, mapper_df
+
+
+# old approach of notes_cleanup.py
+def join_with_groupby(meals_df, notes_df, mapper_df):
+    meals_df_to_merge = meals_df.reset_index()[["meal_id", "meal_name"]]
+    meals_with_notes = pd.merge(left=meals_df_to_merge, right=mapper_df, how="left", left_on="meal_id", right_on="meal_id")
+    meals_with_notes = pd.merge(left=meals_with_notes, right=notes_df, how="left", left_on="note_id", right_index=True)
+    meals_with_notes["notes_nan_filled"] = meals_with_notes["notes_name"].fillna("N/A")
+    return meals_with_notes.groupby("meal_id").agg(notes_list=("notes_nan_filled", lambda col: ";".join(col)), notes_count=("notes_name", "count"))
+
+
+# new approach of notes_cleanup.py (including building the note sets)
+def join_with_note_sets(meals_df, notes_df, mapper_df):
+    note_sets = NoteSets.from_pairs(meals_df.index, mapper_df["meal_id"].to_numpy(), mapper_df["note_id"].to_numpy())
+    return note_sets.note_lists(notes_df["notes_name"])
+
+
+if __name__ == "__main__":
+    meals_df, notes_df, mapper_df = create_data()
+    print(f"{N_MEALS} meals, {mapper_df.shape[0]} meal-note pairs, {N_NOTES} notes")
+
+    groupby_time, expected = best_time(join_with_groupby, meals_df, notes_df, mapper_df)
+    note_sets_time, result = best_time(join_with_note_sets, meals_df, notes_df, mapper_df)
+
+    # both approaches need to produce the same note lists and counts
+    pd.testing.assert_frame_equal(result, expected, check_names=False, check_dtype=False)
+
+    print(f"merge + groupby lambda: {groupby_time:.2f} s")
+    print(f"note sets:              {note_sets_time:.2f} s")
+    print(f"speedup:                {groupby_time / note_sets_time:.1f}x")
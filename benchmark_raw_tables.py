@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Dec 13 15:02:51 2023
+
+@author: Tuni
+"""
+
+# this file compares pandas' single-threaded read_csv with the parallel reader of the raw tables (see raw_tables.py)
+# the parallel reader is run with 1, 2, 4, ... threads up to the number of cores, so we can see how wall-clock time scales with cores
+# it writes a synthetic meals.csv (including quoted names with commas and line breaks) into a temporary folder, so it can be run without the raw data
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import raw_tables
+from benchmarking import best_time, synthetic_prices
+
+# size of the synthetic meals.csv
+N_MEALS = 5_000_000
+
+
+# synthetic meals.csv with the same columns as the OpenMensa dump
+def create_data(base_dir, seed=0):
+    rng = np.random.default_rng(seed)
+    meal_names = np.array(["Spaghetti Bolognese", "Currywurst, Pommes", 'Schnitzel "Wiener Art"', "Gemüsesuppe\nmit Brötchen", "Vollkornbrötchen", None], dtype=object)
+    meals_df = pd.DataFrame({"id": np.arange(N_MEALS) + 1,
+                             "day_id": rng.integers(0, 3_000_000, N_MEALS),
+                             "name": meal_names[rng.integers(0, len(meal_names), N_MEALS)],
+                             "description": None,
+                             "category": rng.choice(["Hauptgericht", "Beilagen", "Dessert", "Salat"], N_MEALS),
+                             "price_student": synthetic_prices(rng, N_MEALS, 0.2),
+                             "price_employee": rng.uniform(2, 8, N_MEALS).round(2),
+                             "price_pupil": np.nan,
+                             "price_other": rng.uniform(3, 10, N_MEALS).round(2),
+                             "pos": rng.integers(0, 10, N_MEALS),
+                             "created_at": "2016-03-01 10:12:31.452189",
+                             "updated_at": "2016-03-01 10:12:31.452189"})
+    meals_df.to_csv(raw_tables.raw_path("meals", base_dir), index=False)
+
+
+# old approach: pandas' default engine (single-threaded)
+def read_with_pandas(base_dir):
+    return pd.read_csv(raw_tables.raw_path("meals", base_dir), sep=",")
+
+
+# new approach: byte ranges parsed in parallel
+def read_in_parallel(base_dir, threads):
+    meals_table, _ = raw_tables.read_raw_table("meals", base_dir=base_dir, threads=threads)
+    return meals_table.to_pandas()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as base_dir:
+        create_data(base_dir)
+        print(f"{N_MEALS} meals, {os.path.getsize(raw_tables.raw_path('meals', base_dir)) / 1024**2:.0f} MB, {os.cpu_count()} cores")
+
+        pandas_time, expected = best_time(read_with_pandas, base_dir)
+        print(f"pandas read_csv:        {pandas_time:.2f} s")
+
+        thread_counts = [2**i for i in range(int(np.log2(os.cpu_count())) + 1)]
+        for threads in thread_counts:
+            parallel_time, result = best_time(read_in_parallel, base_dir, threads)
+            print(f"parallel ({threads:>2} threads):  {parallel_time:.2f} s  ({pandas_time / parallel_time:.1f}x)")
+
+        # both readers need to produce the same table
+        assert result.shape == expected.shape
+        assert (result["id"].to_numpy() == expected["id"].to_numpy()).all()
+        assert result["name"].fillna("").astype(str).equals(expected["name"].fillna("").astype(str))
+        assert np.allclose(result["price_student"].to_numpy(dtype="float64"), expected["price_student"].to_numpy(), equal_nan=True)
+
+        # edge case: a CSV with only a header gives an empty table with all features (same as pandas)
+        with open(raw_tables.raw_path("meals", base_dir), "w", encoding="utf-8") as file:
+            file.write(",".join(expected.columns) + "\n")
+        empty_table, empty_rows = raw_tables.read_raw_table("meals", base_dir=base_dir)
+        assert empty_rows == 0 and empty_table.num_rows == 0
+        assert empty_table.column_names == list(read_with_pandas(base_dir).columns)
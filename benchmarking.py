@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Nov 29 10:41:17 2023
+
+@author: Tuni
+"""
+
+# this file contains the helpers shared by the benchmark_*.py files: timing of the approaches and the synthetic data
+# of the same shape as the raw data (so the benchmarks can be run without it)
+
+import time
+
+import numpy as np
+import pandas as pd
+
+# number of repetitions per approach, the best run is reported
+REPETITIONS = 3
+
+
+# runs the function REPETITIONS times and returns the best time and the result of the last run
+def best_time(function, *args):
+    times = []
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+# synthetic meal-note mapper of the same shape as meals_notes.csv: meal ids drawn uniformly from [0, meal_id_stop),
+# note ids drawn from a zipf distribution (a few notes are very common) and capped at max_note_id
+# ATTENTION: meal_id_stop and max_note_id can be larger than the number of meals and notes to get mapper rows of unknown
+# meals and notes
+def synthetic_meal_notes(rng, n_pairs, meal_id_stop, max_note_id):
+    mapper_df = pd.DataFrame({"meal_id": rng.integers(0, meal_id_stop, n_pairs),
+                              "note_id": np.minimum(rng.zipf(1.5, n_pairs) - 1, max_note_id)})
+    return mapper_df[~mapper_df.duplicated(keep="first")]
+
+
+# synthetic student prices between 1 and 6 euros, a share of them missing
+def synthetic_prices(rng, n, missing_share):
+    return np.where(rng.random(n) < missing_share, np.nan, rng.uniform(1, 6, n).round(2))
@@ -11,6 +11,8 @@ import pandas as pd
 import geopandas as gpd
 import matplotlib.pyplot as plt
 
+import storage
+
 pd.set_option("display.max_columns", None)
 pd.set_option("display.max_rows", None)
 
@@ -249,5 +251,7 @@ universities = canteen_gdf[canteen_gdf["canteen_org"] == "university"]
 #######################################################
 
 # before saving, drop columns that now contain all the same information
-clean_data = universities.drop(columns=["country", "canteen_org"])
-clean_data.to_pickle("data/processed_data/canteens_cleaned.pkl")
+# geometry can't be stored in Parquet and can be rebuilt from latitude / longitude at any time -> drop it too and save a normal pandas df
+clean_data = universities.drop(columns=["country", "canteen_org", "geometry"])
+clean_data = pd.DataFrame(clean_data)
+storage.write_table(clean_data, "canteens_cleaned")
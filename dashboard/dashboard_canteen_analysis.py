@@ -7,38 +7,65 @@ Created on Thu Oct 19 08:28:35 2023
 
 # this file is for setting up the dashboard of our canteen analysis
 
+import os
+import sys
+import uuid
+
+import numpy as np
 import pandas as pd
-from dash import Dash, dcc, html, Output, Input, dash_table, ctx
+import pyarrow.compute as pc
+from dash import Dash, dcc, html, Output, Input, State, dash_table, ctx
 import plotly.express as px
 
+# the storage layer lives in the repository root, one level above the dashboard
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import indicators
+import storage
+from selection_cache import SelectionCache
+from drilldown_index import DrilldownIndex
+import table_backend
+from figure_cache import FigureCache
+
 pd.set_option("display.max_columns", None)
 pd.set_option("display.max_rows", None)
 
-# load data that we want to use for plotting -> canteen_df for map
-canteen_df = pd.read_pickle("../data/processed_data/canteens_cleaned.pkl") # change to absolute path for code to run smootly
+# location of the processed data relative to the dashboard folder
+processed_data_dir = "../data/processed_data" # change to absolute path for code to run smootly
+
+# open the snapshots built by dashboard_snapshot.py
+# ATTENTION: snapshots are memory-mapped, so opening them is cheap and independent of the number of meals
+# all worker processes share the same pages of the snapshot file instead of holding their own copy of the data
+# canteen data is small, so we can convert it to pandas right away -> canteen_df for map
+# canteen_table is also the dimension of the meal table: canteen features are looked up by canteen_id instead of being stored per meal
+canteen_table = storage.open_snapshot("dashboard_canteens", base_dir=processed_data_dir)
+canteen_df = canteen_table.to_pandas()
 canteen_df = canteen_df.set_index(keys="canteen_id")
 
-# load meal data that we want to display in table below graphs
-# important: use .pkl file because it loads a lot quicker -> then reset index to obtain int index for displaying data in data table with ease
-meals_df = pd.read_pickle("../data/processed_data/meals_cleaned_with_notes.pkl",
-                       sep=",", parse_dates=[2, 3, 12, 13, 14, 17, 18, 19], nrows=100) # change to absolute path for code to run smootly
+# meal data that we want to display in table below graphs stays an Arrow table
+# only the page that is displayed in the data table is converted to pandas
+meals_table = storage.open_snapshot("dashboard_meals", base_dir=processed_data_dir)
+
+# build index for the click-to-table drill-down once while loading: (year, month, group) -> row positions
+# grouping features that are not contained in the snapshot yet are skipped and filtered by a full scan instead
+grouping_attributes = ["canteen_id", "canteen_studierendenwerk", "diet_type"]
+drilldown_index = DrilldownIndex(meals_table, grouping_attributes)
 
 cols_to_include = ["meal_id", "meal_name", "meal_category", "meal_price_student", "date_correct", "canteen_name", "canteen_address", "canteen_city", "meal_super_category", "notes_list_90"]
 
-# global attribute: current meal selection (needed for data table)
-current_meal_selection = meals_df
+# server-side cache for the meal selections of all sessions (needed for data table)
+# the selection itself (clicked month + group) is stored in the browser session, so every worker process can rebuild it in case of a cache miss
+selection_cache = SelectionCache(max_entries=256, ttl_seconds=30*60, max_bytes=256*1024**2)
 
 # load data that we want to use for plotting -> indicators_df for timeline graphs
-indicators_df = pd.read_csv("../data/indicators/indicators.csv") # change to absolute path for code to run smootly
+# indicators and the figures built from them are kept in a cache that is reloaded as soon as indicators.csv changes
+figure_cache = FigureCache("../data/indicators/indicators.csv", canteen_df) # change to absolute path for code to run smootly
 
 # extract data needed for dropdown and radio buttons
-indicators_set = indicators_df.columns[4:]
-
-# for plotting purposes we should combine year and month again
-# it will just be a string for now, also easier to control formatting -> use ISO format "YYYY-MM" so that plotly can infer date
-indicators_df["date"] = indicators_df["year"].astype("str") + "-" + indicators_df["month"].astype("str")
+# indicators are taken from the indicator registry (only the ones already contained in indicators.csv)
+indicators_set = [name for name in indicators.INDICATORS if name in figure_cache.indicators_set]
 
-indicators_df = pd.merge(left=indicators_df, right=canteen_df, how="left", left_on="canteen_id", right_index=True)
+# build figures of the default view (focus on canteens, grouped by canteen ID) for all indicators while the dashboard starts
+figure_cache.warm([(indicator, "canteens", "canteen_id") for indicator in indicators_set])
 
 # create a reference to an external stylesheet for formatting the look of the dashboard
 # especially declare where font family to use is located
@@ -48,6 +75,9 @@ external_stylesheets = [{"href": ("https://fonts.googleapis.com/css2?family=Lato
 # initialize dashboard object, tell it to use external stylesheet that we have created apart
 app = Dash(__name__, external_stylesheets=external_stylesheets)
 
+# expose flask server so that the dashboard can be run by a WSGI server with multiple workers (e.g., gunicorn)
+server = app.server
+
 # this is the text displayed in the browser tab and as header in (Google) search results
 app.title = "Canteen Analytics: Nutrition Transition in German university Canteens"
 
@@ -69,7 +99,7 @@ fig.update_traces(hovertemplate="<b>%{customdata[2]}</b> <br><br>Address: %{cust
 
 
 # now define the layout of the dashboard -> using hierarchical code similar to HTML
-app.layout = html.Div(
+dashboard_layout = html.Div(
     
     # all elements of the dashboard
     children=[
@@ -111,7 +141,7 @@ app.layout = html.Div(
                             className="menu-title"),
                         dcc.Dropdown(
                             id="indicator-filter",
-                            options=[{"label": indicator, "value": indicator} for indicator in indicators_set], # list of dicts created with list comprehension
+                            options=[{"label": indicators.INDICATORS[indicator].label, "value": indicator} for indicator in indicators_set], # list of dicts created with list comprehension
                             value="avg_count_meals",
                             clearable=False,
                             #multi=True,
@@ -179,10 +209,16 @@ app.layout = html.Div(
                     id="meals-table",
                     columns=[{"name": col, "id": col} for col in cols_to_include],
                     
-                    # set attributes necessary for paging
+                    # set attributes necessary for paging, sorting and filtering
+                    # all of them are handled on the server (see update_table), the table only displays the current page
                     page_current=0,
                     page_size=10,
                     page_action="custom",
+                    sort_action="custom",
+                    sort_mode="multi",
+                    sort_by=[],
+                    filter_action="custom",
+                    filter_query="",
                     style_table={"overflowX": "auto"},
                     style_cell={"textAlign": "left", 
                                 "paddingLeft": "10px",
@@ -207,6 +243,18 @@ app.layout = html.Div(
         ])
 
 
+# the layout is served by a function, so that every page load gets its own session ID
+# the stores keep the session ID and the current meal selection on the client side
+def serve_layout():
+    return html.Div(
+        children=[
+            dcc.Store(id="session-id", data=str(uuid.uuid4())),
+            dcc.Store(id="meal-selection"),
+            dashboard_layout])
+
+app.layout = serve_layout
+
+
 @app.callback(
     Output("grouping-filter", "options"),
     Output("grouping-filter", "value"),
@@ -248,76 +296,100 @@ def update_charts(indicator, focus, group_attribute):
 
     print(indicator)    
 
-    # filter the data indicated by parameters
-    filtered_data = indicators_df[(indicators_df["canteen_id"] == 24) | (indicators_df["canteen_id"] == 1)]
-    
-    # assign attribute to group data by (use canteen_id as default)
+    # figures are built once per combination of indicator, focus and grouping feature and then served from cache
     # by using default values in dropdown assignment we have assured that group_attribute will never be empty
-    group_by = "canteen_name" # group_attribute
-    needed_for_table = group_attribute
-
-    # create a line chart using plotly express
-    fig = px.line(data_frame=filtered_data,
-                  x="date",
-                  y=indicator,
-                  #line_group="canteen_id",
-                  color=group_by,
-                  custom_data=[needed_for_table, group_by],
-                  labels={"avg_count_meals": "Average count of meals/day", "canteen_id": "Canteen ID", "date": "Date"},
-                  color_discrete_sequence=px.colors.colorbrewer.Paired,
-                  markers=True,
-                  title=f"{indicator} per {group_by}",
-                  template="plotly_white")
+    return figure_cache.get(indicator, focus, group_attribute)
+
+# find the row positions of all meals that belong to a selection (clicked-upon month and group)
+# positions refer to meals_table, so pages can be taken from there directly
+def select_meals(selection):
+    date = pd.Timestamp(selection["month"])
+    
+    # indexed grouping features just need a lookup
+    if selection["attribute"] in drilldown_index:
+        return drilldown_index.lookup(date.year, date.month, selection["attribute"], selection["value"])
+    
+    # otherwise filter all meals that belong to the clicked-upon month and year
+    # then filter by grouping feature also (no grouping feature: chart shows the average of all canteens -> all meals of the month)
+    meal_dates = meals_table["date_correct"]
+    mask = pc.and_(pc.equal(pc.month(meal_dates), date.month), pc.equal(pc.year(meal_dates), date.year))
+    if selection["attribute"] is not None:
+        mask = pc.and_(mask, pc.equal(table_backend.join_dimension(meals_table, [selection["attribute"]], canteen_table)[selection["attribute"]], selection["value"]))
+    return np.flatnonzero(mask.to_numpy(zero_copy_only=False))
+
+
+# look up the row positions of a selection (after filtering and sorting) in the cache
+# rebuild them if they are not cached (e.g., evicted or cached by another worker)
+def get_result_positions(session_id, selection, filter_query, sort_by):
+    selection_key = None if selection is None else (selection["month"], selection["attribute"], selection["value"])
+    sort_key = tuple((sort["column_id"], sort["direction"]) for sort in sort_by)
+    key = (session_id, selection_key, filter_query, sort_key)
     
-    return fig
+    positions = selection_cache.get(key)
+    if positions is None:
+        base_positions = None if selection is None else select_meals(selection)
+        positions = table_backend.query_positions(meals_table, base_positions, filter_query, sort_by, dimension=canteen_table)
+        selection_cache.put(key, positions)
+    return positions
+
 
 # this method updates the table at the end of the dashboard
-# it contains two different events: 
+# it contains different events: 
     # (1) clicking on the arrows to maneuver through data -> this will load the next page of table
-    # (2) clicking on a month in the graph and loading the data used for building the aggregated indicator
+    # (2) sorting or filtering the table -> this will load the first page of the new result
+    # (3) clicking on a month in the graph and loading the data used for building the aggregated indicator
 # ATTENTION: table cannot be updated in two different methods, so we need to distinguish which event triggered the update
 @app.callback(
     Output('meals-table', 'data'),
+    Output('meals-table', 'page_count'),
+    Output('meals-table', 'page_current'),
+    Output("meal-selection", "data"),
     Input('meals-table', "page_current"),
     Input('meals-table', "page_size"),
+    Input('meals-table', "sort_by"),
+    Input('meals-table', "filter_query"),
     Input("avg-count-main-dishes-chart", "clickData"),
-    Input("grouping-filter", "value"))
-def update_table(page_current, page_size, click_data, grouping_attribute):
-    global current_meal_selection
+    Input("grouping-filter", "value"),
+    State("session-id", "data"),
+    State("meal-selection", "data"))
+def update_table(page_current, page_size, sort_by, filter_query, click_data, grouping_attribute, session_id, selection):
     
     # first of all check which event triggered the update
     trigger = ctx.triggered_id
+    sort_by = sort_by or []
+    filter_query = filter_query or ""
     
-    # if event was triggered by table load the next page
-    if trigger == "meals-table":
-        # we need to select the next page, but only columns we want to display
-        # transfer them to dict format that dash app needs
-        return current_meal_selection.loc[page_current*page_size:(page_current+ 1)*page_size, cols_to_include].to_dict('records')
-
-    # if event was triggered by graph, load corresponding data
+    # if event was triggered by graph, set the new meal selection
     if trigger == "avg-count-main-dishes-chart":
-        # we have set up graph in a way that upon clicking, it will return the group_by feature in the customdata feature
+        # we have set up graph in a way that upon clicking, it will return the value of the group_by feature and the group_by feature itself
+        # in the customdata feature (the chart can fall back to another grouping feature than the selected one, see figure_cache.build_figure)
         # we also have the clicked-upon date given by the x position
         print(click_data)
-        date = click_data["points"][0]["x"]
-        current_group = click_data["points"][0]["customdata"][0]
+        date = pd.Timestamp(click_data["points"][0]["x"])
+        current_group, current_attribute = click_data["points"][0]["customdata"][:2]
         print(f"Date: {date} Type: {type(date)}")
         print(f"Current group of grouping feature: {current_group}")
         
-        # now we can convert the date to a timestamp so that we can ue it for filtering our data more easily
-        # filter all meals that belong to the clicked-upon month and year
-        # then filter by grouping feature also
-        date = pd.Timestamp(date)
-        filtered_meals = meals_df[(meals_df["date_correct"].dt.month == date.month) & (meals_df["date_correct"].dt.year == date.year)]
-        filtered_meals = filtered_meals[filtered_meals[grouping_attribute] == current_group]
-        
-        print(filtered_meals.shape)
-        
-        # set the new current meal selection for being able to browse the table correctly
-        current_meal_selection = filtered_meals        
+        # the selection is stored in the browser session for being able to browse the table correctly
+        # ATTENTION: use ISO format "YYYY-MM" for the month so that the selection can be used as cache key
+        selection = {"month": date.strftime("%Y-%m"), "attribute": current_attribute, "value": current_group}
+    
+    # a new selection, sort order or filter starts on the first page again
+    # ATTENTION: page_current is an output as well, otherwise the table would still show the old page number
+    if trigger == "avg-count-main-dishes-chart" or "meals-table.sort_by" in ctx.triggered_prop_ids or "meals-table.filter_query" in ctx.triggered_prop_ids:
+        page_current = 0
+    
+    with table_backend.RequestTimer(f"page {page_current} (filter: '{filter_query}', sort: {sort_by})"):
+        # without selection, filter and sort order we can page through the snapshot directly
+        if selection is None and not filter_query and not sort_by:
+            page = table_backend.join_dimension(meals_table.slice(page_current*page_size, page_size), cols_to_include, canteen_table)
+            return page.select(cols_to_include).to_pandas().to_dict("records"), table_backend.page_count(range(meals_table.num_rows), page_size), page_current, selection
         
+        # load the current page of the selection
         # before returning data, remember to convert entries to dictionary for compliance with dash framework
-        return filtered_meals.loc[0:page_size, cols_to_include].to_dict("records")
+        positions = get_result_positions(session_id, selection, filter_query, sort_by)
+        data = table_backend.get_page(meals_table, positions, page_current, page_size, cols_to_include, dimension=canteen_table)
+        return data, table_backend.page_count(positions, page_size), page_current, selection
 
 # run the app
 if __name__ == "__main__":
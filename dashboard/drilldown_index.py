@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Nov 17 14:32:05 2023
+
+@author: Tuni
+"""
+
+# this file contains the index used for the click-to-table drill-down of the dashboard
+# for every grouping feature, meals are ordered by (month, group) once while loading
+# a click on a chart point (month + group) then only needs a dict lookup and returns a contiguous range of that order
+
+import numpy as np
+import pandas as pd
+
+
+class DrilldownIndex:
+
+    # table: meal snapshot (Arrow table) with feature date_correct
+    # attributes: grouping features that should be indexed, features not contained in table are skipped
+    def __init__(self, table, attributes):
+        # months since 1970-01 -> one integer key for year and month
+        dates = table["date_correct"].to_numpy().astype("datetime64[M]")
+        month_codes = dates.astype("int64")
+
+        # attribute -> (order of rows or None if rows are already in order, dict (year, month, group) -> (start, stop))
+        self._indices = {}
+        for attribute in attributes:
+            if attribute in table.column_names:
+                self._indices[attribute] = self._build(month_codes, table[attribute].to_numpy())
+
+    @staticmethod
+    def _build(month_codes, values):
+        # factorize group values so that we can combine month and group into one integer key
+        # ATTENTION: use sorted codes, otherwise keys of an already sorted snapshot would not be sorted anymore
+        codes, uniques = pd.factorize(values, sort=True)
+        keys = month_codes * len(uniques) + codes
+
+        # meals without value for this feature (code -1) can't be selected anyways, they get a negative key and are skipped below
+        keys[codes < 0] = -1
+
+        if len(keys) == 0:
+            return None, {}
+
+        # the snapshot is sorted by month and canteen_id (see dashboard_snapshot.py), so for canteen_id we can skip sorting completely
+        # other grouping features (e.g., meal_super_category) are not in order within a month and need to be sorted once
+        if np.all(keys[1:] >= keys[:-1]):
+            order = None
+        else:
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+
+        # find start and stop of each (month, group) key in the sorted keys
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        stops = np.r_[starts[1:], len(keys)]
+        sorted_keys = keys[starts]
+
+        valid = sorted_keys >= 0
+        starts, stops, sorted_keys = starts[valid], stops[valid], sorted_keys[valid]
+
+        # convert keys back to year, month and group value (as Python objects, so that they match values from the dashboard)
+        key_months = sorted_keys // len(uniques)
+        key_groups = uniques[sorted_keys % len(uniques)].tolist()
+        key_years = (key_months // 12 + 1970).tolist()
+        key_months = (key_months % 12 + 1).tolist()
+
+        ranges = dict(zip(zip(key_years, key_months, key_groups), zip(starts.tolist(), stops.tolist())))
+        return order, ranges
+
+    # check if grouping feature is indexed
+    def __contains__(self, attribute):
+        return attribute in self._indices
+
+    # row positions of all meals of a month and group, empty if there are none
+    def lookup(self, year, month, attribute, value):
+        order, ranges = self._indices[attribute]
+        start, stop = ranges.get((year, month, value), (0, 0))
+        if order is None:
+            return np.arange(start, stop)
+        return order[start:stop]
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Nov 21 10:17:53 2023
+
+@author: Tuni
+"""
+
+# this file contains the cache for the indicator charts of the dashboard
+# building a figure with plotly express takes long (especially with one line per canteen), so every figure is only built once
+# figures are cached by (indicator, focus, grouping feature) and the cache is cleared as soon as indicators.csv changes
+
+import os
+import threading
+
+import pandas as pd
+import plotly.express as px
+
+import indicators
+
+
+# load indicators and prepare them for plotting
+# returns the prepared indicators and the names of the indicator features (all features after canteen_id, year and month)
+def load_indicators(indicators_path, canteen_df):
+    indicators_df = pd.read_csv(indicators_path)
+    indicators_set = list(indicators_df.columns[4:])
+
+    # for plotting purposes we should combine year and month again
+    # it will just be a string for now, also easier to control formatting -> use ISO format "YYYY-MM" so that plotly can infer date
+    indicators_df["date"] = indicators_df["year"].astype("str") + "-" + indicators_df["month"].astype("str").str.zfill(2)
+
+    indicators_df = pd.merge(left=indicators_df, right=canteen_df, how="left", left_on="canteen_id", right_index=True)
+    return indicators_df, indicators_set
+
+
+# grouping features that can be selected for each focus (see set_grouping_options in dashboard_canteen_analysis.py)
+FOCUS_GROUPS = {"canteens": ["canteen_id", "canteen_studierendenwerk"],
+                "meals": ["diet_type", "meal_type"],
+                "cluster_analysis": []}
+
+# one line per canteen is only readable for a few canteens -> only plot the canteens with the most months of data
+MAX_CANTEEN_LINES = 10
+
+
+# build line chart of an indicator, one line per group of the grouping feature
+# the custom data of every point is (value of the grouping feature, grouping feature), the drill-down into the meal table uses both
+# ATTENTION: the grouping feature actually used can differ from the requested one (see below), so the click has to take it from the point
+def build_figure(indicators_df, indicator, focus, group_attribute):
+    # grouping features that don't belong to the focus or that are not contained in the indicators yet (e.g., diet type) can't be used
+    # -> average the indicator over all canteens, grouping feature None selects all meals of the month
+    if group_attribute not in FOCUS_GROUPS.get(focus, []) or group_attribute not in indicators_df.columns:
+        group_attribute = None
+
+    if group_attribute == "canteen_id":
+        # one line per canteen, labelled with name and ID (canteens can share a name)
+        counts = indicators_df.loc[indicators_df[indicator].notna(), "canteen_id"].value_counts()
+        counts = counts.rename_axis("canteen_id").reset_index(name="months").sort_values(by=["months", "canteen_id"], ascending=[False, True])
+        plot_data = indicators_df.loc[indicators_df["canteen_id"].isin(counts["canteen_id"].head(MAX_CANTEEN_LINES)), ["date", "canteen_id", "canteen_name", indicator]]
+        plot_data["group"] = plot_data["canteen_name"].astype(str) + " (" + plot_data["canteen_id"].astype(str) + ")"
+        plot_data = plot_data.rename(columns={"canteen_id": "value"})
+        title = f"{indicator} of the {min(MAX_CANTEEN_LINES, len(counts))} canteens with the most months of data"
+    elif group_attribute is not None:
+        # average the indicator over all canteens of a group
+        plot_data = indicators_df.groupby(by=["date", group_attribute], as_index=False)[indicator].mean()
+        plot_data["group"] = plot_data[group_attribute]
+        plot_data = plot_data.rename(columns={group_attribute: "value"})
+        title = f"{indicator} per {group_attribute}"
+    else:
+        plot_data = indicators_df.groupby(by="date", as_index=False)[indicator].mean()
+        plot_data["group"] = "All canteens"
+        plot_data["value"] = None
+        title = f"{indicator} (average of all canteens)"
+
+    plot_data["attribute"] = group_attribute
+    plot_data = plot_data.sort_values(by=["date", "group"])
+
+    # create a line chart using plotly express
+    fig = px.line(data_frame=plot_data,
+                  x="date",
+                  y=indicator,
+                  color="group",
+                  custom_data=["value", "attribute"],
+                  labels={**{name: registered.label for name, registered in indicators.INDICATORS.items()}, "group": group_attribute or "", "date": "Date"},
+                  color_discrete_sequence=px.colors.colorbrewer.Paired,
+                  markers=True,
+                  title=title,
+                  template="plotly_white")
+
+    # cache the figure as dict, this is what dash needs to send it to the browser anyways
+    return fig.to_dict()
+
+
+class FigureCache:
+
+    def __init__(self, indicators_path, canteen_df):
+        self.indicators_path = indicators_path
+        self.canteen_df = canteen_df
+
+        # dash serves callbacks from multiple threads -> guard all accesses
+        self._lock = threading.Lock()
+        self._figures = {}
+        self._version = None
+        self.indicators_df = None
+        self.indicators_set = []
+        self._reload_if_changed()
+
+    # modification time and size of indicators.csv identify the version of the indicators
+    def _current_version(self):
+        stat = os.stat(self.indicators_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    # reload indicators and clear all cached figures if indicators.csv changed since it was loaded
+    def _reload_if_changed(self):
+        version = self._current_version()
+        with self._lock:
+            if version == self._version:
+                return
+            self.indicators_df, self.indicators_set = load_indicators(self.indicators_path, self.canteen_df)
+            self._figures = {}
+            self._version = version
+
+    # return figure from cache, build it if it hasn't been requested before
+    def get(self, indicator, focus, group_attribute):
+        self._reload_if_changed()
+        key = (indicator, focus, group_attribute)
+
+        with self._lock:
+            figure = self._figures.get(key)
+            indicators_df = self.indicators_df
+        if figure is not None:
+            return figure
+
+        # ATTENTION: build figure outside of lock, otherwise all other requests would have to wait
+        figure = build_figure(indicators_df, indicator, focus, group_attribute)
+        with self._lock:
+            # only keep figure if indicators haven't changed while building it
+            if indicators_df is self.indicators_df:
+                self._figures[key] = figure
+        return figure
+
+    # build figures of common combinations in a background thread, so that the dashboard can start right away
+    def warm(self, combinations):
+        def build_all():
+            for indicator, focus, group_attribute in combinations:
+                self.get(indicator, focus, group_attribute)
+
+        thread = threading.Thread(target=build_all, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Nov 16 11:05:12 2023
+
+@author: Tuni
+"""
+
+# this file contains the server-side cache for meal selections of the dashboard
+# a selection is stored as the row positions of the selected meals within the meal snapshot
+# this way, browsing through the meal table is just a lookup of the positions of the current page
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class SelectionCache:
+
+    # max_entries: maximum number of selections kept in cache
+    # ttl_seconds: selections that haven't been used for this long are removed
+    # max_bytes: memory cap for all cached row positions together
+    def __init__(self, max_entries=256, ttl_seconds=30*60, max_bytes=256*1024**2):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+        # key -> (row positions, timestamp of last access), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._size = 0
+
+        # dash serves callbacks from multiple threads -> guard all accesses
+        self._lock = threading.Lock()
+
+    # return cached row positions for a key or None if not cached (or expired)
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            positions, last_access = entry
+            now = time.monotonic()
+            if now - last_access > self.ttl_seconds:
+                self._remove(key)
+                return None
+
+            # mark as most recently used
+            self._entries[key] = (positions, now)
+            self._entries.move_to_end(key)
+            return positions
+
+    # add row positions for a key, then evict least recently used entries until cache is within its limits again
+    def put(self, key, positions):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            # ATTENTION: selections bigger than the whole memory cap would evict everything else, so don't cache them at all
+            if positions.nbytes > self.max_bytes:
+                return
+
+            self._entries[key] = (positions, time.monotonic())
+            self._size += positions.nbytes
+            self._evict()
+
+    def _remove(self, key):
+        positions, _ = self._entries.pop(key)
+        self._size -= positions.nbytes
+
+    def _evict(self):
+        # first remove expired entries, they are located at the front since they have been used least recently
+        now = time.monotonic()
+        while self._entries:
+            key, (_, last_access) = next(iter(self._entries.items()))
+            if now - last_access <= self.ttl_seconds:
+                break
+            self._remove(key)
+
+        # then remove least recently used entries until count and memory are within limits
+        while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+            key = next(iter(self._entries))
+            self._remove(key)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Nov 20 09:48:26 2023
+
+@author: Tuni
+"""
+
+# this file contains the server-side query backend of the meal table in the dashboard
+# the data table only sends page, sort and filter settings, all the work is done here on the Arrow snapshot
+# only the rows of the visible page are ever converted to pandas / dicts
+# canteen features are not stored per meal in the snapshot, they are looked up in the canteen dimension (canteen snapshot) by canteen_id
+
+import re
+import time
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# operators of the dash data table filter syntax, e.g. "{meal_price_student} > 3 && {meal_name} contains Reis"
+# ATTENTION: order matters, longer operators need to be matched first (otherwise ">=" would be matched as ">")
+FILTER_OPERATORS = {">=": pc.greater_equal, "ge": pc.greater_equal,
+                    "<=": pc.less_equal, "le": pc.less_equal,
+                    "!=": pc.not_equal, "ne": pc.not_equal,
+                    ">": pc.greater, "gt": pc.greater,
+                    "<": pc.less, "lt": pc.less,
+                    "=": pc.equal, "eq": pc.equal,
+                    "contains": None,
+                    "datestartswith": None}
+
+# the data table puts "i" (case-insensitive) or "s" (case-sensitive) in front of the operator if case matters, e.g. "s>" or "icontains"
+FILTER_PATTERN = re.compile(r"^\{(?P<column>[^}]+)\}\s*(?P<case>[is])?(?P<operator>" + "|".join(re.escape(op) for op in FILTER_OPERATORS) + r")\s*(?P<value>.*)$")
+
+# key joining meals and the canteen dimension
+DIMENSION_KEY = "canteen_id"
+
+
+# split the filter query of the data table into (column, operator, value, case) tuples, case: "i", "s" or "" (no prefix)
+# parts that can't be parsed are ignored
+def parse_filter_query(filter_query):
+    filters = []
+    if not filter_query:
+        return filters
+
+    for part in filter_query.split(" && "):
+        match = FILTER_PATTERN.match(part.strip())
+        if match is None:
+            continue
+
+        value = match.group("value").strip()
+        # quoted values are always strings, e.g. {meal_category} = "Beilagen"
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'`":
+            value = value[1:-1]
+
+        filters.append((match.group("column"), match.group("operator"), value, match.group("case") or ""))
+    return filters
+
+
+# ATTENTION: categorical features are dictionary-encoded in the snapshot -> decode them, most compute functions only work on plain arrays
+def _plain_column(table, column):
+    array = table[column]
+    if pa.types.is_dictionary(array.type):
+        array = array.cast(array.type.value_type)
+    return array
+
+
+# add features of the dimension (e.g., canteen_name) that are requested but not contained in table
+# dimension: Arrow table with one row per canteen_id, None if there is no dimension
+def join_dimension(table, columns, dimension):
+    if dimension is None:
+        return table
+    missing = [col for col in columns if col not in table.column_names and col in dimension.column_names]
+    if not missing:
+        return table
+
+    # row of the dimension of every meal, only computed for the rows of table (e.g., one page)
+    dimension_rows = pc.index_in(table[DIMENSION_KEY], value_set=dimension[DIMENSION_KEY].combine_chunks())
+    for col in missing:
+        table = table.append_column(col, dimension[col].take(dimension_rows))
+    return table
+
+
+# features that can be filtered, sorted and displayed
+def _available_columns(table, dimension):
+    return table.column_names + ([] if dimension is None else dimension.column_names)
+
+
+# evaluate one filter on a table and return boolean mask
+# returns None if the value doesn't fit the type of the feature (e.g., "abc" for a price or "2015" for a date) or the operator doesn't
+# fit the feature (e.g., datestartswith on a meal name) -> filter is ignored
+# ATTENTION: contains ignores case unless the data table asks for case-sensitive filtering ("scontains")
+def _filter_mask(table, column, operator, value, case=""):
+    array = _plain_column(table, column)
+
+    if operator == "contains":
+        return pc.match_substring(pc.cast(array, pa.string()), value, ignore_case=case != "s")
+    if operator == "datestartswith":
+        if not (pa.types.is_timestamp(array.type) or pa.types.is_date(array.type)):
+            return None
+        return pc.starts_with(pc.strftime(array, format="%Y-%m-%d"), value)
+
+    # convert value to the type of the feature before comparing, e.g. "3.5" for prices
+    try:
+        if pa.types.is_timestamp(array.type):
+            value = pa.scalar(datetime.fromisoformat(value), type=array.type)
+        elif pa.types.is_integer(array.type) or pa.types.is_floating(array.type):
+            value = float(value)
+    except ValueError:
+        return None
+    if case == "i" and pa.types.is_string(array.type):
+        array, value = pc.utf8_lower(array), value.lower()
+    return FILTER_OPERATORS[operator](array, value)
+
+
+# find row positions (referring to table) of all rows that remain after filtering and sorting
+# positions: start from these rows (e.g., a selection from the drill-down), None means all rows
+# sort_by: sort settings of the data table, list of {"column_id": ..., "direction": "asc"/"desc"}
+# dimension: canteen dimension, features of the dimension are looked up only for the rows that need to be filtered / sorted
+def query_positions(table, positions=None, filter_query=None, sort_by=None, dimension=None):
+    if positions is None:
+        positions = np.arange(table.num_rows)
+    available = _available_columns(table, dimension)
+    filters = parse_filter_query(filter_query)
+    sort_by = [sort for sort in (sort_by or []) if sort["column_id"] in available]
+
+    # nothing to do -> return rows in their stored order
+    if not filters and not sort_by:
+        return positions
+
+    # only take the features needed for filtering and sorting
+    needed = list(dict.fromkeys([column for column, _, _, _ in filters] + [sort["column_id"] for sort in sort_by]))
+    needed = [column for column in needed if column in available]
+    stored = [column for column in needed if column in table.column_names]
+    if len(stored) < len(needed) and DIMENSION_KEY not in stored:
+        stored.append(DIMENSION_KEY)
+    subset = join_dimension(table.select(stored).take(positions), needed, dimension)
+
+    for column, operator, value, case in filters:
+        if column not in subset.column_names:
+            continue
+        mask = _filter_mask(subset, column, operator, value, case)
+        if mask is None:
+            continue
+        mask = pc.fill_null(mask, False)
+        subset = subset.filter(mask)
+        positions = positions[np.flatnonzero(mask.to_numpy(zero_copy_only=False))]
+
+    if sort_by:
+        # decode categorical features, otherwise they would be sorted by dictionary code instead of value
+        sort_table = pa.table({sort["column_id"]: _plain_column(subset, sort["column_id"]) for sort in sort_by})
+        sort_keys = [(sort["column_id"], "ascending" if sort["direction"] == "asc" else "descending") for sort in sort_by]
+        order = pc.sort_indices(sort_table, sort_keys=sort_keys).to_numpy()
+        positions = positions[order]
+
+    return positions
+
+
+# select one page of rows and convert it to dict format that dash app needs
+def get_page(table, positions, page_current, page_size, columns, dimension=None):
+    start = page_current*page_size
+    page = join_dimension(table.take(positions[start:start + page_size]), columns, dimension)
+    return page.select(columns).to_pandas().to_dict("records")
+
+
+# number of pages of a result, at least 1 so that the data table doesn't show "1 of 0"
+def page_count(positions, page_size):
+    return max(1, -(-len(positions) // page_size))
+
+
+# measure response time of a table request and print it (one line per request)
+class RequestTimer:
+
+    def __init__(self, description):
+        self.description = description
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        print(f"[meals-table] {self.description} took {elapsed_ms:.1f} ms")
+        return False
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Nov 15 09:21:48 2023
+
+@author: Tuni
+"""
+
+# this file builds the snapshot of the processed data that is opened by the dashboard
+# the dashboard memory-maps the snapshot instead of loading the full tables on startup (see storage.open_snapshot)
+
+import pandas as pd
+
+import star_schema
+import storage
+
+pd.set_option("display.max_columns", None)
+pd.set_option("display.max_rows", None)
+
+#######################################################
+# CANTEENS
+#######################################################
+
+# canteens are needed for the map and for labelling the indicator charts
+canteen_df = storage.read_table("canteens_cleaned")
+canteen_df = canteen_df.reset_index()
+
+storage.write_snapshot(canteen_df, "dashboard_canteens")
+
+#######################################################
+# MEALS
+#######################################################
+
+# only select features that are displayed in the meal table of the dashboard (+ canteen_id for grouping), meal_id is the index
+# ATTENTION: canteen features (name, address, city) are not stored per meal, the dashboard looks them up in the canteen snapshot by canteen_id
+dashboard_meal_columns = ["meal_name", "meal_category", "meal_price_student", "date_correct", "canteen_id", "meal_super_category", "notes_list_90"]
+meals_df = star_schema.query_meals(dashboard_meal_columns)
+meals_df = meals_df.reset_index()
+
+# sort by month and canteen so that meals of the same month are stored next to each other in the snapshot (and thus on the same memory pages)
+# ATTENTION: month before canteen_id (not date), then the (month, canteen_id) keys of the drill-down index are sorted already and it doesn't
+# need to sort the snapshot while loading (see dashboard/drilldown_index.py), within a canteen and month meals stay sorted by date
+meals_df["month"] = meals_df["date_correct"].to_numpy().astype("datetime64[M]")
+meals_df = meals_df.sort_values(by=["month", "canteen_id", "date_correct", "meal_id"], ignore_index=True)
+meals_df = meals_df.drop(columns="month")
+
+# categories repeat a lot -> they are read as categoricals already and stored dictionary-encoded (see storage.SCHEMAS)
+print(meals_df.dtypes)
+print(f"Shape of dashboard snapshot: {meals_df.shape}")
+
+storage.write_snapshot(meals_df, "dashboard_meals")
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Dec 12 10:04:18 2023
+
+@author: Tuni
+"""
+
+# this file contains the date repair of days.csv used in days_cleanup.py
+# dates ("YYYY-MM-DD") are parsed straight from the bytes of an Arrow string array into int32 day numbers (days since 1970-01-01),
+# wrong years (e.g., the typo "4012" instead of "2012", see days_exploration.py) are fixed arithmetically and entries that collide with an
+# existing entry after the fix are resolved in one sort-based pass -> no object strings, no str.replace / str.contains / duplicated passes
+# the timeframe filter of days_cleanup.py can then run on the integer day numbers as well
+# dates are parsed chunk by chunk while reading days.csv (see raw_tables.read_days), collisions are resolved once all chunks are read
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# wrong year -> correct year, all typos found in days_exploration.py
+YEAR_FIXES = {4012: 2012}
+
+# layout of a date string: "YYYY-MM-DD"
+DATE_LENGTH = 10
+DIGIT_POSITIONS = [0, 1, 2, 3, 5, 6, 8, 9]
+SEPARATOR_POSITIONS = [4, 7]
+
+
+# day number (days since 1970-01-01) of a date
+def day_number(year, month, day):
+    return int((np.datetime64(f"{year:04d}-{month:02d}-{day:02d}", "D") - np.datetime64("1970-01-01", "D")).astype("int64"))
+
+
+# convert day numbers back into dates
+def to_datetime(day_numbers):
+    return pd.Series(np.asarray(day_numbers).astype("datetime64[D]").astype("datetime64[ns]"))
+
+
+# parse "YYYY-MM-DD" strings into years, months and days, strings: anything pyarrow can turn into a string array
+# returns (1) years, months, days as int32 arrays and (2) mask of the valid strings (correct length, digits and separators)
+# ATTENTION: only the bytes of the Arrow array are read, the values are never converted into Python strings
+def _parse_digits(strings):
+    array = strings if isinstance(strings, (pa.Array, pa.ChunkedArray)) else pa.array(strings, type=pa.string())
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    array = array.cast(pa.string())
+
+    n_rows = len(array)
+    _, offsets_buffer, data_buffer = array.buffers()
+    offsets = np.frombuffer(offsets_buffer, dtype=np.int32)[array.offset:array.offset + n_rows + 1]
+    data = np.frombuffer(data_buffer, dtype=np.uint8) if data_buffer is not None else np.zeros(0, dtype=np.uint8)
+
+    valid = (np.diff(offsets) == DATE_LENGTH) & ~np.asarray(array.is_null())
+    if valid.all():
+        # usual case: all strings have the same length and lie next to each other -> the bytes are just reshaped, no copy
+        chars = data[offsets[0]:offsets[-1]].reshape(n_rows, DATE_LENGTH)
+    else:
+        chars = np.zeros((n_rows, DATE_LENGTH), dtype=np.uint8)
+        chars[valid] = data[offsets[:-1][valid, None] + np.arange(DATE_LENGTH)]
+
+    digits = chars.astype(np.int32) - ord("0")
+    valid &= ((digits[:, DIGIT_POSITIONS] >= 0) & (digits[:, DIGIT_POSITIONS] <= 9)).all(axis=1)
+    valid &= (chars[:, SEPARATOR_POSITIONS] == ord("-")).all(axis=1)
+
+    years = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    months = digits[:, 5] * 10 + digits[:, 6]
+    days = digits[:, 8] * 10 + digits[:, 9]
+    return years, months, days, valid
+
+
+# turn years, months and days into day numbers, invalid dates (e.g., 2013-02-30) are marked in valid
+def _day_numbers(years, months, days, valid):
+    valid = valid & (months >= 1) & (months <= 12)
+    month_keys = np.where(valid, (years.astype(np.int64) - 1970) * 12 + months - 1, 0)
+    month_starts = month_keys.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    month_lengths = (month_keys + 1).astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) - month_starts
+    valid &= (days >= 1) & (days <= month_lengths)
+    return np.where(valid, month_starts + days - 1, 0).astype(np.int32), valid
+
+
+# parse the dates of days.csv and fix wrong years (see YEAR_FIXES), dates: "YYYY-MM-DD" strings (Arrow array or series)
+# returns (1) day numbers (int32), (2) mask of the repaired entries and (3) mask of the valid dates (strings that aren't valid dates are rejected)
+def parse_dates(dates):
+    years, months, days, valid = _parse_digits(dates)
+
+    # fix wrong years arithmetically
+    repaired = np.zeros(len(years), dtype=bool)
+    for wrong_year, correct_year in YEAR_FIXES.items():
+        is_wrong = valid & (years == wrong_year)
+        years = np.where(is_wrong, correct_year, years)
+        repaired |= is_wrong
+
+    day_numbers, valid = _day_numbers(years, months, days, valid)
+    return day_numbers, repaired & valid, valid
+
+
+# find repaired entries that collide with another entry of the same canteen and day after the year fix
+# these are duplicates (the entry with the correct date already exists) and need to be dropped
+# returns mask of the entries to drop
+# ATTENTION: same as in the old pipeline, duplicates without repaired entries are kept (they are real entries of the raw data)
+def resolve_collisions(day_numbers, canteen_ids, repaired):
+    # sort by (canteen, day number) -> entries of the same canteen and day are next to each other
+    # canteen and day are combined into one integer key (canteen in the upper 32 bits), so one sort of int64 keys is enough
+    keys = (np.asarray(canteen_ids, dtype=np.int64) << 32) + (np.asarray(day_numbers, dtype=np.int64) + 2**31)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    group_starts = np.ones(len(order), dtype=bool)
+    group_starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    group_ids = np.cumsum(group_starts) - 1
+
+    # every repaired entry of a group with more than one entry collides with another entry
+    collides = np.zeros(len(keys), dtype=bool)
+    collides[order] = np.bincount(group_ids)[group_ids] > 1
+    return collides & np.asarray(repaired, dtype=bool)
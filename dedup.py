@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Nov 30 10:21:47 2023
+
+@author: Tuni
+"""
+
+# this file contains the duplicate detection used in meals_cleanup.py
+# instead of hashing the (long) key strings twice with duplicated(keep=False) and duplicated(keep="first"), every key is hashed
+# once into a 64-bit fingerprint, both the number of duplicates and the first-occurrence mask are derived from the fingerprints
+# ATTENTION: the meals are checked after they have been joined with the cleaned days (canteen_id, date_correct), so they are in memory
+# anyways -> the fingerprints (8 bytes per row) only add a small share to that, there is no need to spill anything to disk
+
+import numpy as np
+import pandas as pd
+
+
+# 64-bit fingerprint of the key of every row
+def fingerprints(df, subset):
+    return pd.util.hash_pandas_object(df[subset], index=False).to_numpy()
+
+
+# find duplicate fingerprints, positions: row positions of the fingerprints
+# returns two masks (in order of fingerprints): duplicated as in duplicated(keep="first") and duplicated(keep=False)
+def _duplicate_masks(row_fingerprints, positions):
+    # sort by fingerprint and position -> first row of every group is the first occurrence
+    order = np.lexsort((positions, row_fingerprints))
+    sorted_fingerprints = row_fingerprints[order]
+    group_starts = np.r_[True, sorted_fingerprints[1:] != sorted_fingerprints[:-1]]
+    group_ids = np.cumsum(group_starts) - 1
+    group_sizes = np.bincount(group_ids)
+
+    duplicated_first = np.empty(len(order), dtype=bool)
+    duplicated_first[order] = ~group_starts
+    duplicated_all = np.empty(len(order), dtype=bool)
+    duplicated_all[order] = group_sizes[group_ids] > 1
+    return duplicated_first, duplicated_all
+
+
+# find duplicates of the key features subset in df
+# returns number of rows that have a duplicate (same as duplicated(keep=False).sum()) and mask of the rows to drop (same as duplicated(keep="first"))
+# verify: fingerprints can collide (very unlikely, but possible) -> rows with equal fingerprints are compared once more with their real keys
+def find_duplicates(df, subset, verify=True):
+    duplicated_first, duplicated_all = _duplicate_masks(fingerprints(df, subset), np.arange(df.shape[0]))
+
+    # only candidates (rows with equal fingerprints) are compared, usually this is a tiny share of all rows
+    if verify:
+        candidates = np.flatnonzero(duplicated_all)
+        candidate_keys = df.iloc[candidates]
+        duplicated_first[candidates] = candidate_keys.duplicated(subset=subset, keep="first").to_numpy()
+        duplicated_all[candidates] = candidate_keys.duplicated(subset=subset, keep=False).to_numpy()
+
+    return int(duplicated_all.sum()), duplicated_first
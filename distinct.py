@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Dec  4 10:12:05 2023
+
+@author: Tuni
+"""
+
+# this file contains the helper to run expensive transforms only once per distinct value of a feature
+# most string features repeat a lot (e.g., a few hundred meal categories cover 90% of the meals), so regex flagging, rules and
+# lookups are applied to the distinct values and the results are broadcast back to all rows -> cost scales with vocabulary size
+
+import numpy as np
+import pandas as pd
+
+
+# apply transform to the distinct values of series and broadcast the results back to the rows of series
+# transform: gets a series of the distinct values, returns one result per distinct value (list, array, series or df with one row per value)
+# skip_na: missing values are not passed to transform but get na_result, otherwise they are transformed like every other value
+# returns series (or df, if transform returns a df) with the same index as series
+def map_distinct(series, transform, skip_na=True, na_result=np.nan):
+    # ATTENTION: with skip_na, factorize codes missing values as -1, which conveniently selects the na_result appended below
+    codes, uniques = pd.factorize(series, use_na_sentinel=skip_na)
+    results = transform(pd.Series(uniques))
+
+    if isinstance(results, pd.DataFrame):
+        na_row = pd.DataFrame([[na_result] * results.shape[1]], columns=results.columns)
+        distinct_results = pd.concat([results.reset_index(drop=True), na_row], ignore_index=True)
+        return distinct_results.take(codes).set_axis(series.index)
+
+    distinct_results = np.concatenate([np.asarray(results), np.asarray([na_result])])
+    return pd.Series(distinct_results[codes], index=series.index, name=series.name)
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Nov 22 13:26:40 2023
+
+@author: Tuni
+"""
+
+# this file contains the calculation of the monthly indicators per canteen used in extract_metrics.py
+# indicators are stored in a partitioned indicator store (see storage.py), so that a run only needs to recompute the
+# (canteen_id, year, month) partitions whose meals changed since the last run
+
+import hashlib
+import inspect
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import meal_flags
+import storage
+
+# every indicator is calculated per canteen and month
+PARTITION_KEYS = ["canteen_id", "year", "month"]
+
+# analysis timeframe (08/2012 - 08/2023) of the indicator grid
+START_YEAR, START_MONTH = 2012, 8
+STOP_YEAR, STOP_MONTH = 2023, 8
+
+
+####################################################################
+# INDICATOR REGISTRY
+####################################################################
+
+# row filters: name -> (features needed, function returning boolean mask of the meals that belong to the population)
+MEAL_FILTERS = {"all": ([], lambda meals_df: np.ones(meals_df.shape[0], dtype=bool)),
+                "not_baked": (["meal_super_category"], lambda meals_df: (meals_df["meal_super_category"] != "baked_goods").to_numpy()),
+                "main_dish": (["meal_super_category"], lambda meals_df: (meals_df["meal_super_category"] == "main_dish").to_numpy()),
+                "not_baked_or_dessert": (["meal_super_category"], lambda meals_df: (~meals_df["meal_super_category"].isin(["baked_goods", "dessert"])).to_numpy())}
+
+# per-meal expressions: name -> (features needed, function returning boolean or numeric value per meal)
+MEAL_VALUES = {"has_name": (["meal_name"], lambda meals_df: meals_df["meal_name"].notna().to_numpy()),
+               "meal_price_student": (["meal_price_student"], lambda meals_df: meals_df["meal_price_student"].to_numpy(dtype="float64"))}
+
+# keyword flags (see meal_flags.py): name -> matcher, usable as value just like MEAL_VALUES
+# flags are derived once by star_schema.build_star_schema and stored in the fact table under their name -> they are read, not matched again
+# (the SQL backend reads the same stored flags), the matcher is only needed to notice changed keywords (see definitions_hash)
+# ATTENTION: vegan meals are not counted as vegetarian by these rules
+MEAL_FLAGS = {"is_vegetarian": meal_flags.NOTE_MATCHER,
+              "is_vegan": meal_flags.NOTE_MATCHER,
+              "contains_whole_grain": meal_flags.NAME_MATCHER}
+
+# day-level aggregations of a value over the meals of the population of one canteen and day
+# a day only counts for an indicator if it contains at least one meal of the population
+    # count: number of meals for which a boolean value is True (e.g., number of meals with a name, same as count() of meal_name)
+    # sum: sum of a boolean value (e.g., number of vegetarian meals)
+    # percent: sum of a boolean value in percent of the meals with a name
+    # mean: mean of a numeric value, days without any values are skipped (e.g., average price)
+DAY_AGGREGATIONS = ["count", "sum", "percent", "mean"]
+
+
+# declaration of an indicator
+# name: feature name in indicators.csv, label: name displayed in the dashboard
+# population: row filter (see MEAL_FILTERS), value: per-meal expression or keyword flag (see MEAL_VALUES, MEAL_FLAGS)
+# day_aggregation: see DAY_AGGREGATIONS, month_aggregation: any pandas aggregation of the daily values of a month (e.g., "mean", "max")
+class Indicator:
+
+    def __init__(self, name, label, population, value, day_aggregation, month_aggregation="mean"):
+        if population not in MEAL_FILTERS:
+            raise ValueError(f"Unknown population '{population}' of indicator '{name}'")
+        if value not in MEAL_VALUES and value not in MEAL_FLAGS:
+            raise ValueError(f"Unknown value '{value}' of indicator '{name}'")
+        if day_aggregation not in DAY_AGGREGATIONS:
+            raise ValueError(f"Unknown day aggregation '{day_aggregation}' of indicator '{name}'")
+
+        self.name = name
+        self.label = label
+        self.population = population
+        self.value = value
+        self.day_aggregation = day_aggregation
+        self.month_aggregation = month_aggregation
+
+
+# all registered indicators by name, in the order they are written to indicators.csv
+INDICATORS = {}
+
+
+def register_indicator(indicator):
+    if indicator.name in INDICATORS:
+        raise ValueError(f"Indicator '{indicator.name}' is already registered")
+    INDICATORS[indicator.name] = indicator
+    return indicator
+
+
+# freedom of choice: how many meals / main dishes are offered per day (baked goods are more cafeteria items)
+register_indicator(Indicator("avg_count_meals", "Average count of meals/day", "not_baked", "has_name", "count"))
+register_indicator(Indicator("avg_count_main_dishes", "Average count of main dishes/day", "main_dish", "has_name", "count"))
+
+# availability of vegetarian and vegan meals: percentage (for comparisons) and total number of options (relevant constraint in everyday life)
+register_indicator(Indicator("avg_count_vegetarian", "Average count of vegetarian meals/day", "all", "is_vegetarian", "sum"))
+register_indicator(Indicator("avg_percent_vegetarian", "Average percent of vegetarian meals/day", "all", "is_vegetarian", "percent"))
+register_indicator(Indicator("avg_count_vegan", "Average count of vegan meals/day", "all", "is_vegan", "sum"))
+register_indicator(Indicator("avg_percent_vegan", "Average percent of vegan meals/day", "all", "is_vegan", "percent"))
+
+# price trends: average student price of main dishes
+register_indicator(Indicator("meal_price_student", "Average student price of main dishes", "main_dish", "meal_price_student", "mean"))
+
+# whole grain supply: baked goods and desserts are excluded (they would skew the results)
+register_indicator(Indicator("avg_count_whole_grain", "Average count of whole grain meals/day", "not_baked_or_dessert", "contains_whole_grain", "sum"))
+register_indicator(Indicator("avg_percent_whole_grain", "Average percent of whole grain meals/day", "not_baked_or_dessert", "contains_whole_grain", "percent"))
+
+
+# features needed to calculate a per-meal expression or keyword flag
+def _value_columns(value):
+    if value in MEAL_FLAGS:
+        return [value]
+    return MEAL_VALUES[value][0]
+
+
+# features of the meal star schema (see star_schema.py) needed to calculate the registered indicators
+def meal_columns(indicators=None):
+    indicators = list(INDICATORS.values()) if indicators is None else indicators
+    columns = ["canteen_id", "date_correct"]
+    for indicator in indicators:
+        columns += MEAL_FILTERS[indicator.population][0] + _value_columns(indicator.value)
+    return list(dict.fromkeys(columns))
+
+
+####################################################################
+# CALCULATE INDICATORS
+####################################################################
+
+# plan the counters needed per canteen and day: every indicator is built from (at most) three sums
+# counters are shared between indicators, e.g. the number of meals with a name is needed by all percentages of the same population
+    # rows: number of meals of the population (a day only counts if > 0)
+    # numerator: sum of the (masked) value, for counts the number of meals with a True value
+    # denominator: number of meals with a name (percent) or number of meals with a value (mean)
+def _plan(indicators):
+    plan = {}
+    for indicator in indicators:
+        population, value = indicator.population, indicator.value
+        counters = {"rows": ("rows", population, None)}
+        # ATTENTION: the value of a count is already boolean (e.g., has_name) -> sum it up, "notna" would be True for every meal
+        if indicator.day_aggregation == "count":
+            counters["numerator"] = ("sum", population, value)
+        elif indicator.day_aggregation == "sum":
+            counters["numerator"] = ("sum", population, value)
+        elif indicator.day_aggregation == "percent":
+            counters["numerator"] = ("sum", population, value)
+            counters["denominator"] = ("sum", population, "has_name")
+        elif indicator.day_aggregation == "mean":
+            counters["numerator"] = ("nansum", population, value)
+            counters["denominator"] = ("notna", population, value)
+        plan[indicator.name] = counters
+    return plan
+
+
+# name of the feature a counter (kind, population, value) is stored in
+def _counter_name(counter):
+    return ":".join(str(part) for part in counter)
+
+
+# calculate the given per-meal expressions and read the given keyword flags, returns dict name -> value per meal
+def _evaluate_values(meals_df, value_names):
+    values = {value: MEAL_VALUES[value][1](meals_df) for value in value_names if value in MEAL_VALUES}
+    for value in value_names:
+        if value in MEAL_FLAGS:
+            values[value] = meals_df[value].to_numpy(dtype=bool)
+
+    return values
+
+
+# calculate one counter for every meal
+def _counter(kind, population_mask, values):
+    if kind == "rows":
+        return population_mask
+    if kind == "sum":
+        return np.where(population_mask, values, 0)
+    if kind == "notna":
+        return population_mask & ~pd.isna(values)
+    if kind == "nansum":
+        return np.where(population_mask & ~pd.isna(values), values, 0.0)
+
+
+# calculate the given indicators (default: all registered indicators) for the given meals
+# returns one row per canteen_id, year and month that contains meals
+# instead of grouping and merging once per indicator, we (1) turn every meal into a row of counters shared by all indicators,
+# (2) sum up the counters of each canteen and day in a single groupby on an integer key, (3) derive the daily values and
+# aggregate them per canteen and month in a second groupby
+def compute_indicators(meals_df, indicators=None):
+    indicators = list(INDICATORS.values()) if indicators is None else indicators
+    indicator_columns = [indicator.name for indicator in indicators]
+    if meals_df.empty:
+        return pd.DataFrame(columns=PARTITION_KEYS + indicator_columns)
+
+    # ------------------ integer keys -------------------
+
+    # canteen and day are combined into one integer key: canteen code * number of days + day number
+    canteen_codes, canteens = pd.factorize(meals_df["canteen_id"], sort=True)
+    days = meals_df["date_correct"].to_numpy().astype("datetime64[D]").astype("int64")
+    first_day = days.min()
+    day_span = days.max() - first_day + 1
+    day_keys = canteen_codes.astype("int64") * day_span + (days - first_day)
+
+    # ------------------ counters per meal -------------------
+
+    # every row filter and per-meal expression is evaluated only once, no matter how many indicators use it
+    plan = _plan(indicators)
+    needed_counters = list(dict.fromkeys(counter for counters in plan.values() for counter in counters.values()))
+    populations = {population: MEAL_FILTERS[population][1](meals_df) for population in {counter[1] for counter in needed_counters}}
+    values = _evaluate_values(meals_df, {counter[2] for counter in needed_counters if counter[2] is not None})
+
+    counters = pd.DataFrame({_counter_name(counter): _counter(counter[0], populations[counter[1]], values.get(counter[2])) for counter in needed_counters})
+
+    # ------------------ (1) sum up counters per canteen and day -------------------
+
+    daily = counters.groupby(by=day_keys, sort=False).sum()
+
+    # ------------------ (2) daily values -------------------
+
+    # days without meals of the population (or without any values for means) get na, they are skipped when aggregating per month
+    daily_values = pd.DataFrame(index=daily.index)
+    for indicator in indicators:
+        indicator_counters = {role: daily[_counter_name(counter)] for role, counter in plan[indicator.name].items()}
+        daily_value = indicator_counters["numerator"]
+        if indicator.day_aggregation == "percent":
+            daily_value = daily_value / indicator_counters["denominator"] * 100
+        elif indicator.day_aggregation == "mean":
+            daily_value = (daily_value / indicator_counters["denominator"]).where(indicator_counters["denominator"] > 0)
+        daily_values[indicator.name] = daily_value.where(indicator_counters["rows"] > 0)
+
+    # decode canteen and month of each day from the integer key
+    daily_keys = daily.index.to_numpy()
+    daily_values["canteen_code"] = daily_keys // day_span
+    daily_values["month_key"] = (daily_keys % day_span + first_day).astype("datetime64[D]").astype("datetime64[M]").astype("int64")
+
+    # ------------------ (3) aggregate per canteen and month -------------------
+
+    month_aggregations = {indicator.name: indicator.month_aggregation for indicator in indicators}
+    monthly = daily_values.groupby(by=["canteen_code", "month_key"], sort=True).agg(month_aggregations).reset_index()
+
+    # month_key counts months since 1970-01
+    indicators_df = pd.DataFrame({"canteen_id": canteens[monthly["canteen_code"].to_numpy()],
+                                  "year": monthly["month_key"].to_numpy() // 12 + 1970,
+                                  "month": monthly["month_key"].to_numpy() % 12 + 1})
+    indicators_df[indicator_columns] = monthly[indicator_columns].to_numpy(dtype="float64")
+
+    return indicators_df
+
+
+####################################################################
+# DETECT CHANGED PARTITIONS
+####################################################################
+
+# hash of everything that decides how indicators are calculated: the registered indicators, the source code of the row filters
+# and per-meal expressions they use, the keywords of the keyword flags (see meal_flags.py) and the code of the calculation itself
+# ATTENTION: the partition fingerprints only cover the meals -> if this hash changes, all partitions need to be recomputed
+# (e.g., a new keyword changes the flags of meals in every partition, a new indicator is missing in every partition, a fixed counter
+# changes the values of every partition)
+def definitions_hash(indicators=None):
+    indicators = list(INDICATORS.values()) if indicators is None else indicators
+    digest = hashlib.sha256()
+    for function in [_plan, _evaluate_values, _counter, compute_indicators]:
+        digest.update(inspect.getsource(function).encode())
+    for indicator in indicators:
+        digest.update(repr((indicator.name, indicator.population, indicator.value, indicator.day_aggregation, indicator.month_aggregation)).encode())
+        digest.update(inspect.getsource(MEAL_FILTERS[indicator.population][1]).encode())
+        if indicator.value in MEAL_FLAGS:
+            digest.update(repr(MEAL_FLAGS[indicator.value].keywords_by_flag).encode())
+        else:
+            digest.update(inspect.getsource(MEAL_VALUES[indicator.value][1]).encode())
+    return digest.hexdigest()
+
+
+# calculate a fingerprint of the meals of every (canteen_id, year, month) partition
+# the fingerprint is the sum of the hashes of all meals (including meal_id), so it changes as soon as a meal is added, removed or changed
+# ATTENTION: sum of uint64 wraps around on overflow, that's fine for a fingerprint and makes it independent of the order of meals
+def partition_fingerprints(meals_df):
+    fingerprints = pd.DataFrame({"canteen_id": meals_df["canteen_id"].to_numpy(),
+                                 "year": meals_df["date_correct"].dt.year.to_numpy(),
+                                 "month": meals_df["date_correct"].dt.month.to_numpy(),
+                                 "row_hash": pd.util.hash_pandas_object(meals_df[meal_columns()], index=True).to_numpy()})
+    return fingerprints.groupby(by=PARTITION_KEYS).agg(meal_count=("row_hash", "size"), fingerprint=("row_hash", "sum")).reset_index()
+
+
+# compare fingerprints with the fingerprints of the last run
+# returns partitions that are new, changed or don't contain any meals anymore
+# ATTENTION: don't use an outer merge here, missing values would turn the uint64 fingerprints into floats and small differences would get lost
+def changed_partitions(fingerprints, previous_fingerprints):
+    current_keys = pd.MultiIndex.from_frame(fingerprints[PARTITION_KEYS])
+    previous_keys = pd.MultiIndex.from_frame(previous_fingerprints[PARTITION_KEYS])
+
+    new = fingerprints.loc[~current_keys.isin(previous_keys), PARTITION_KEYS]
+    removed = previous_fingerprints.loc[~previous_keys.isin(current_keys), PARTITION_KEYS]
+
+    both = pd.merge(left=fingerprints, right=previous_fingerprints, how="inner", on=PARTITION_KEYS, suffixes=("", "_previous"))
+    changed = both.loc[(both["fingerprint"] != both["fingerprint_previous"]) | (both["meal_count"] != both["meal_count_previous"]), PARTITION_KEYS]
+
+    return pd.concat([new, removed, changed], ignore_index=True)
+
+
+####################################################################
+# INDICATOR STORE
+####################################################################
+
+# calculate indicators of the given meals with the given backend
+# backend="sql" calculates them straight from the processed tables with DuckDB (see indicators_sql.py) instead of meals_df
+# partitions: restrict the calculation to these (canteen_id, year, month) partitions (None: all partitions)
+def _compute_with_backend(meals_df, partitions, backend):
+    if backend == "sql":
+        # ATTENTION: imported here, duckdb is an optional dependency
+        import indicators_sql
+        return indicators_sql.compute_indicators(partitions=partitions)
+    if backend != "pandas":
+        raise ValueError(f"Unknown backend '{backend}'")
+
+    if partitions is None:
+        return compute_indicators(meals_df)
+    meal_keys = pd.MultiIndex.from_arrays([meals_df["canteen_id"], meals_df["date_correct"].dt.year, meals_df["date_correct"].dt.month])
+    return compute_indicators(meals_df[meal_keys.isin(pd.MultiIndex.from_frame(partitions))])
+
+
+# recompute indicators of changed partitions only and upsert them into the indicator store
+# incremental=False (or missing store) recomputes all partitions, so does a change of the indicator definitions (see definitions_hash)
+# backend: "pandas" (compute_indicators) or "sql" (indicators_sql.compute_indicators, same results)
+# returns the number of recomputed partitions
+def update_indicator_store(meals_df, incremental=True, base_dir=storage.INDICATORS_DIR, backend="pandas"):
+    fingerprints = partition_fingerprints(meals_df)
+
+    # the hash of the indicator definitions is stored next to the fingerprints (same value in every row)
+    fingerprints["definitions_hash"] = definitions_hash()
+    previous_fingerprints = None
+    if incremental and storage.table_exists("indicator_fingerprints", base_dir):
+        previous_fingerprints = storage.read_table("indicator_fingerprints", base_dir=base_dir)
+
+    if previous_fingerprints is None or "definitions_hash" not in previous_fingerprints.columns or \
+            (previous_fingerprints["definitions_hash"] != fingerprints["definitions_hash"].iloc[0]).any():
+        storage.write_table(_compute_with_backend(meals_df, None, backend), "indicators", base_dir=base_dir)
+        storage.write_table(fingerprints, "indicator_fingerprints", base_dir=base_dir)
+        return fingerprints.shape[0]
+
+    changed = changed_partitions(fingerprints, previous_fingerprints)
+    if changed.empty:
+        return 0
+
+    # recompute indicators only for meals of the changed partitions
+    changed_keys = pd.MultiIndex.from_frame(changed)
+    new_indicators = _compute_with_backend(meals_df, changed, backend)
+
+    # the indicator store is partitioned by year -> rewrite the affected years
+    # keep unchanged rows of these years, replace changed ones (partitions without meals are dropped)
+    affected_years = changed["year"].unique().tolist()
+    old_indicators = storage.read_table("indicators", filters=[("year", "in", affected_years)], base_dir=base_dir)
+    old_keys = pd.MultiIndex.from_frame(old_indicators[PARTITION_KEYS])
+    old_indicators = old_indicators[~old_keys.isin(changed_keys)]
+
+    updated_indicators = pd.concat([old_indicators, new_indicators], ignore_index=True)
+    if not updated_indicators.empty:
+        storage.write_partitions(updated_indicators, "indicators", base_dir=base_dir)
+
+    # ATTENTION: write_partitions only replaces years that still contain rows -> delete years that lost all their meals
+    remaining_years = set(updated_indicators["year"].astype("int64").tolist())
+    storage.delete_partitions("indicators", [year for year in affected_years if int(year) not in remaining_years], base_dir=base_dir)
+    storage.write_table(fingerprints, "indicator_fingerprints", base_dir=base_dir)
+    return changed.shape[0]
+
+
+# read the indicator store and expand it to the full grid of canteens and months of the analysis timeframe
+# missing months are filled up with na (same format as indicators.csv used by the dashboard)
+def indicator_grid(base_dir=storage.INDICATORS_DIR):
+    indicators_df = storage.read_table("indicators", base_dir=base_dir)
+    canteens = storage.read_table("indicator_fingerprints", columns=["canteen_id"], base_dir=base_dir)["canteen_id"].unique()
+
+    # since year and month are just numbers, it's easiest to just create dates made of two int lists
+    # now take cartesian product to obtain list with all combinations of canteens and dates
+    months = [x for x in range(1, 13)]
+    years = [x for x in range(START_YEAR, STOP_YEAR + 1)]
+    results_df = pd.DataFrame(list(itertools.product(canteens, years, months)), columns=PARTITION_KEYS)
+
+    # filter rows out of analysis timeframe (< 08/2012 or > 08/2023)
+    results_df = results_df[(results_df["year"] != START_YEAR) | (results_df["month"] >= START_MONTH)]
+    results_df = results_df[(results_df["year"] != STOP_YEAR) | (results_df["month"] <= STOP_MONTH)]
+
+    # ATTENTION: year is read back from the partition folders as int16 -> align data types before merging
+    indicators_df["year"] = indicators_df["year"].astype("int64")
+    results_df = pd.merge(left=results_df, right=indicators_df, how="left", on=PARTITION_KEYS)
+    return results_df.reset_index(drop=True)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Dec 11 09:52:31 2023
+
+@author: Tuni
+"""
+
+# this file contains the optional SQL backend of the indicator calculation (see indicators.py)
+# the processed Parquet tables of the star schema (see star_schema.py) are registered in DuckDB, an embedded analytical SQL engine
+# that scans and aggregates them multi-threaded, without loading the meals into pandas first
+# every indicator of the registry is translated into SQL expressions, the results are the same as the ones of indicators.compute_indicators
+# ATTENTION: duckdb is an optional dependency (pip install duckdb), everything else works without it
+
+import os
+
+import indicators
+import storage
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# tables of the star schema needed to calculate indicators
+SQL_TABLES = ["meal_facts", "dim_calendar", "dim_categories"]
+
+# SQL versions of the row filters of indicators.MEAL_FILTERS
+# ATTENTION: comparisons with NULL are NULL in SQL, but pandas compares missing super categories as "not equal" -> same results via IS DISTINCT FROM
+SQL_FILTERS = {"all": "TRUE",
+               "not_baked": "meal_super_category IS DISTINCT FROM 'baked_goods'",
+               "main_dish": "meal_super_category IS NOT DISTINCT FROM 'main_dish'",
+               "not_baked_or_dessert": "meal_super_category IS NULL OR meal_super_category NOT IN ('baked_goods', 'dessert')"}
+
+# SQL versions of the per-meal expressions of indicators.MEAL_VALUES
+# keyword flags (indicators.MEAL_FLAGS) don't need a translation, they are stored in the fact table already (see star_schema.build_star_schema)
+SQL_VALUES = {"has_name": "meal_name IS NOT NULL",
+              "meal_price_student": "CAST(meal_price_student AS DOUBLE)"}
+
+# SQL versions of the month aggregations (pandas aggregation -> SQL aggregate function)
+SQL_MONTH_AGGREGATIONS = {"mean": "avg", "median": "median", "min": "min", "max": "max"}
+
+
+# check if the SQL backend can be used
+def available():
+    return duckdb is not None
+
+
+# open an in-memory DuckDB database with views on the processed tables
+# threads: number of threads DuckDB uses for scans and aggregations (None: all cores)
+def connect(base_dir=storage.PROCESSED_DATA_DIR, threads=None):
+    if duckdb is None:
+        raise ImportError("The SQL backend needs duckdb (pip install duckdb)")
+
+    con = duckdb.connect()
+    if threads is not None:
+        con.execute(f"SET threads TO {int(threads)}")
+    for name in SQL_TABLES:
+        path = os.path.join(storage.table_path(name, base_dir), "**", "*.parquet").replace("\\", "/")
+        con.execute(f"CREATE VIEW {name} AS SELECT * FROM read_parquet('{path}', hive_partitioning = true)")
+    return con
+
+
+# SQL expression of a per-meal expression or keyword flag
+def _value_sql(value):
+    if value in indicators.MEAL_FLAGS:
+        return value
+    if value in SQL_VALUES:
+        return SQL_VALUES[value]
+    raise ValueError(f"Value '{value}' has no SQL translation")
+
+
+# SQL aggregate of a counter (kind, population, value) of indicators._plan, summed up per canteen and day
+def _counter_sql(counter):
+    kind, population, value = counter
+    if population not in SQL_FILTERS:
+        raise ValueError(f"Population '{population}' has no SQL translation")
+    population_sql = f"coalesce({SQL_FILTERS[population]}, FALSE)"
+
+    if kind == "rows":
+        return f"count(*) FILTER (WHERE {population_sql})"
+    if kind == "sum":
+        return f"coalesce(sum(CAST({_value_sql(value)} AS DOUBLE)) FILTER (WHERE {population_sql}), 0)"
+    # ATTENTION: only for numeric values (denominator of means), a boolean expression like has_name is never NULL and would count
+    # every meal -> counts of boolean values are planned as "sum" (see indicators._plan)
+    if kind == "notna":
+        return f"count(*) FILTER (WHERE {population_sql} AND ({_value_sql(value)}) IS NOT NULL)"
+    if kind == "nansum":
+        return f"coalesce(sum({_value_sql(value)}) FILTER (WHERE {population_sql}), 0)"
+
+
+# SQL expression of the daily value of an indicator, counters: role -> column of the counter in the daily table
+# days without meals of the population (or without any values for means) get NULL, same as in indicators.compute_indicators
+# ATTENTION: SQL division by zero is NULL, but pandas divides like floats: flagged meals without a name give an infinite percentage, 0 / 0 gives na
+def _daily_value_sql(indicator, counters):
+    numerator = f"CAST({counters['numerator']} AS DOUBLE)"
+    if indicator.day_aggregation == "percent":
+        return (f"CASE WHEN {counters['rows']} > 0 AND {counters['denominator']} > 0 THEN {numerator} / {counters['denominator']} * 100 "
+                f"WHEN {counters['rows']} > 0 AND {numerator} > 0 THEN 'inf'::DOUBLE END")
+    if indicator.day_aggregation == "mean":
+        return f"CASE WHEN {counters['rows']} > 0 AND {counters['denominator']} > 0 THEN {numerator} / {counters['denominator']} END"
+    return f"CASE WHEN {counters['rows']} > 0 THEN {numerator} END"
+
+
+# build the query that calculates the given indicators, partitions: restrict the calculation to the partitions in table "partitions"
+# same steps as indicators.compute_indicators: (1) counters per canteen and day, (2) daily values, (3) aggregation per canteen and month
+def indicator_query(indicator_list, partitions=False):
+    plan = indicators._plan(indicator_list)
+    needed_counters = list(dict.fromkeys(counter for counters in plan.values() for counter in counters.values()))
+    counter_columns = {counter: f"counter_{position}" for position, counter in enumerate(needed_counters)}
+
+    daily_columns = [f"{_counter_sql(counter)} AS {column}" for counter, column in counter_columns.items()]
+    value_columns = []
+    for indicator in indicator_list:
+        if indicator.month_aggregation not in SQL_MONTH_AGGREGATIONS:
+            raise ValueError(f"Month aggregation '{indicator.month_aggregation}' of indicator '{indicator.name}' has no SQL translation")
+        counters = {role: counter_columns[counter] for role, counter in plan[indicator.name].items()}
+        value_columns.append(f"{SQL_MONTH_AGGREGATIONS[indicator.month_aggregation]}({_daily_value_sql(indicator, counters)}) AS \"{indicator.name}\"")
+
+    partition_join = "JOIN partitions p ON f.canteen_id = p.canteen_id AND c.year = p.year AND c.month = p.month" if partitions else ""
+
+    newline = ",\n               "
+    return f"""
+        WITH meals AS (
+            SELECT f.* EXCLUDE (year), CAST(c.year AS BIGINT) AS year, CAST(c.month AS BIGINT) AS month, k.meal_super_category
+            FROM meal_facts f
+            JOIN dim_calendar c ON f.date_key = c.date_key
+            LEFT JOIN dim_categories k ON f.category_id = k.category_id
+            {partition_join}
+        ),
+        daily AS (
+            SELECT canteen_id, year, month, date_key,
+               {newline.join(daily_columns)}
+            FROM meals
+            GROUP BY canteen_id, year, month, date_key
+        )
+        SELECT CAST(canteen_id AS BIGINT) AS canteen_id, year, month,
+               {newline.join(value_columns)}
+        FROM daily
+        GROUP BY canteen_id, year, month
+        ORDER BY canteen_id, year, month
+    """
+
+
+# calculate the given indicators (default: all registered indicators) straight from the processed tables
+# partitions: df with canteen_id, year and month of the partitions to calculate (None: all partitions that contain meals)
+# returns the same df as indicators.compute_indicators for all meals of the star schema
+def compute_indicators(indicator_list=None, partitions=None, base_dir=storage.PROCESSED_DATA_DIR, threads=None):
+    indicator_list = list(indicators.INDICATORS.values()) if indicator_list is None else indicator_list
+
+    con = connect(base_dir, threads=threads)
+    try:
+        if partitions is not None:
+            con.register("partitions", partitions[indicators.PARTITION_KEYS].astype("int64"))
+        indicators_df = con.execute(indicator_query(indicator_list, partitions=partitions is not None)).df()
+    finally:
+        con.close()
+
+    indicator_columns = [indicator.name for indicator in indicator_list]
+    indicators_df[indicator_columns] = indicators_df[indicator_columns].astype("float64")
+    return indicators_df
@@ -13,6 +13,10 @@ import random
 import numpy as np
 import matplotlib.pyplot as plt
 
+import meal_flags
+import note_sets
+import star_schema
+
 pd.set_option("display.max_columns", None)
 pd.set_option("display.max_rows", None)
 
@@ -30,7 +34,10 @@ layout_color = "#004E8A"
 ####################################################################
 
 # read meal data that we want to classify
-meals_df = pd.read_pickle("data/processed_data/meals_cleaned_with_notes.pkl")
+# ATTENTION: Parquet dataset is read partition by partition -> sort by meal_id to restore original order, otherwise iloc-based samples below change
+# canteen features, categories and note lists are joined by the query API (see star_schema.py)
+meals_df = star_schema.query_meals(["meal_name", "meal_category", "date_correct", "canteen_name", "canteen_address", "meal_super_category", "notes_list", "notes_count", "notes_list_90", "notes_count_90"])
+meals_df = meals_df.sort_index()
 
 # replace N/A with np.nan since while reading pickle file na values are not automatically parsed
 meals_df[["notes_list", "notes_list_90"]] = meals_df[["notes_list", "notes_list_90"]].replace(to_replace="N/A", value=np.nan)
@@ -45,10 +52,14 @@ note_categories = pd.read_csv("data/helper_data/analysis_subset_notes_categories
 
 # (1) test run -----------------------------------------------------
 
-# based on 90% of covered meal-note associations, we will derive rules for vegan and vegetarian dishes
-# ATTENTION: vegan meals are not considered vegetarian by rules
-meals_df["is_vegetarian"] = meals_df["notes_list_90"].str.contains(pat="vegetarisch|ohne Fleisch|fleischlos|kein Fleisch|ovo-lacto-vegetabil|OLV", case=False, regex=True)
-meals_df["is_vegan"] = meals_df["notes_list_90"].str.contains(pat="vegan", case=False, regex=True)
+# based on 90% of covered meal-note associations, we will derive rules for vegan and vegetarian dishes (see meal_flags.py)
+# rules are only matched against the names of the 90% most common notes, meals are flagged by the IDs of their notes (see note_sets.py)
+# ATTENTION: vegan meals are not considered vegetarian by rules, meals without notes get False
+notes_vocabulary = note_sets.load_vocabulary()
+meal_note_sets = note_sets.load_note_sets(meals_df.index, common_only=True)
+dietary_flags = meal_flags.dietary_flags_by_note_ids(meal_note_sets, notes_vocabulary["notes_name"])
+meals_df["is_vegetarian"] = dietary_flags["is_vegetarian"]
+meals_df["is_vegan"] = dietary_flags["is_vegan"]
 
 # the remaining dishes will be marked as omnivorous
 meals_df["is_omnivorous"] = (~(meals_df["is_vegan"] | meals_df["is_vegetarian"]))
@@ -60,10 +71,9 @@ temp = meals_df[meals_df["is_vegan"] & meals_df["is_vegetarian"]]
 # (2) final classification -----------------------------------------
 
 # based on 90% of covered meal-note associations, we will derive rules for vegan and vegetarian dishes
-# ATTENTION: vegan meals are considered vegetarian by rules
-# ATTENTION: declare na=False to assign meals without notes boolean value instead of np.nan
-meals_df["is_vegetarian"] = meals_df["notes_list_90"].str.contains(pat="vegetarisch|ohne Fleisch|fleischlos|kein Fleisch|ovo-lacto-vegetabil|OLV|vegan", case=False, regex=True, na=False)
-meals_df["is_vegan"] = meals_df["notes_list_90"].str.contains(pat="vegan", case=False, regex=True, na=False)
+# ATTENTION: vegan meals are considered vegetarian by rules -> combine flags of the test run, no need to scan notes again
+meals_df["is_vegetarian"] = dietary_flags["is_vegetarian"] | dietary_flags["is_vegan"]
+meals_df["is_vegan"] = dietary_flags["is_vegan"]
 
 # non-vegetarian dishes will be marked as omnivorous
 meals_df["is_omnivorous"] = ~meals_df["is_vegetarian"]
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Nov 27 10:02:18 2023
+
+@author: Tuni
+"""
+
+# this file contains the rule-based flagging of meals (dietary type based on notes, whole grain based on meal name)
+# instead of running str.contains once per rule over millions of meals, all keywords of a feature are compiled into one matcher
+# the matcher only runs once per distinct value (notes lists and meal names repeat a lot) and finds all flags in one scan
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from distinct import map_distinct
+
+# keywords of each flag, matched case-insensitively anywhere in the text
+# based on 90% of covered meal-note associations (see analysis_subset_notes_categories_with_counts.csv)
+# ATTENTION: vegan meals are not flagged as vegetarian by these keywords, combine both flags if vegan meals should count as vegetarian
+NOTE_KEYWORDS = {"is_vegetarian": ["vegetarisch", "ohne Fleisch", "fleischlos", "kein Fleisch", "ovo-lacto-vegetabil", "OLV"],
+                 "is_vegan": ["vegan"]}
+
+# if meal_name contains "Vollkorn", mark as whole grain (without recipe there is no other way for us to know)
+NAME_KEYWORDS = {"contains_whole_grain": ["Vollkorn"]}
+
+
+class KeywordMatcher:
+
+    def __init__(self, keywords_by_flag):
+        self.flag_names = list(keywords_by_flag)
+        self.keywords_by_flag = {flag: list(keywords) for flag, keywords in keywords_by_flag.items()}
+
+        # lookup from (case-folded) keyword to the position of its flag
+        self._flag_positions = {}
+        for position, flag in enumerate(self.flag_names):
+            for keyword in keywords_by_flag[flag]:
+                self._flag_positions[keyword.casefold()] = position
+
+        # one alternation of all keywords, longer keywords first so that they win if keywords start at the same position
+        # ATTENTION: matches don't overlap, so keywords of different flags must not overlap either (not the case for our keywords)
+        keywords = sorted(self._flag_positions, key=len, reverse=True)
+        self._pattern = re.compile("|".join(re.escape(keyword) for keyword in keywords), flags=re.IGNORECASE)
+
+    # positions of all flags found in one text
+    def _match(self, text):
+        return {self._flag_positions[match.casefold()] for match in self._pattern.findall(text)}
+
+    # flags of distinct texts, one row per text and one boolean feature per flag
+    def _flag_table(self, texts):
+        distinct_flags = np.zeros((len(texts), len(self.flag_names)), dtype=bool)
+        for row, text in enumerate(texts):
+            for position in self._match(str(text)):
+                distinct_flags[row, position] = True
+        return pd.DataFrame(distinct_flags, columns=self.flag_names)
+
+    # flag every value of a series, returns df with one boolean feature per flag (missing values are never flagged)
+    # the matcher only runs once per distinct value (see distinct.py)
+    def flags(self, series):
+        return map_distinct(series, self._flag_table, na_result=False)
+
+    # IDs of notes that carry a flag, e.g. all note IDs that mark a meal as vegan
+    # note_names: series of note names indexed by note ID (e.g., notes_df["notes_name"])
+    # with the note IDs of a meal, flagging is then just a set lookup instead of matching joined strings
+    def note_ids(self, note_names, flag):
+        note_flags = self.flags(note_names)
+        return set(note_flags.index[note_flags[flag]])
+
+
+# matchers used throughout the project
+NOTE_MATCHER = KeywordMatcher(NOTE_KEYWORDS)
+NAME_MATCHER = KeywordMatcher(NAME_KEYWORDS)
+
+
+# all dietary flags of meals based on their notes (e.g., notes_list_90)
+def dietary_flags(notes):
+    return NOTE_MATCHER.flags(notes)
+
+
+# all dietary flags of meals based on the IDs of their notes (see note_sets.py)
+# every note name is only matched once, the meals are then flagged by integer lookups
+# note_names: series of note names indexed by note ID (e.g., notes_name of the note vocabulary)
+def dietary_flags_by_note_ids(note_sets, note_names):
+    note_flags = NOTE_MATCHER.flags(note_names)
+    return pd.DataFrame({flag: note_sets.has_any(note_flags.index[note_flags[flag]]) for flag in NOTE_MATCHER.flag_names})
+
+
+# whole grain flag of meals based on their names
+def whole_grain_flags(meal_names):
+    return NAME_MATCHER.flags(meal_names)["contains_whole_grain"]
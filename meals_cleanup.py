@@ -9,67 +9,80 @@ Created on Mon Sep 25 08:54:19 2023
 
 import pandas as pd
 import numpy as np
+import pyarrow.compute as pc
+
+import dedup
+import raw_tables
+import storage
+from distinct import map_distinct
+from rule_engine import Rule, RuleSet
 
 pd.set_option("display.max_columns", None)
 pd.set_option("display.max_rows", None)
 
 #######################################################
-# READ IN DATA
+# LOAD CLEANED CANTEENS AND DAYS
 #######################################################
 
-# read in CSV
-meals_df = pd.read_csv("data/raw_data/meals.csv", sep=",")
+# to reduce the amount of data we are working with (execution time, complexity, etc.), filter data based on cleaned canteens.csv and days.csv
+# we load them before reading meals.csv so that every range of meals can be filtered right away and the full meal table never needs to be in memory
+# ATTENTION: only canteen_id (+ name for printing) is needed, canteen features are not joined onto the meals anymore (see star_schema.query_meals)
+canteen_df = storage.read_table("canteens_cleaned", columns=["canteen_name"])
+days_df = storage.read_table("days_cleaned", columns=["canteen_id", "date", "date_correct", "days_created_at", "days_updated_at"])
 
-# check if parsing worked correctly
-print(meals_df.head())
-print(f"Shape of meals.csv: {meals_df.shape}")
+# keys we need to keep a meal: its day has to be contained in days_df (which is already filtered to our analysis canteens)
+analysis_days_set = pd.Index(days_df.index.astype("int64"))
 
 #######################################################
-# THE BASICS: COLUMN NAMES, COLUMNS NEEDED, DATA TYPES, INDEX
+# READ IN DATA
 #######################################################
 
-# check columns to see if they need to be renamed
-print(f"Column headers: {meals_df.columns}")
+# meals.csv is by far the biggest file of the dump, so it is split into byte ranges that are parsed in parallel (see raw_tables.py)
+# compact data types are declared up front (see raw_tables.RAW_TABLES) and empty or unneeded columns (description, pos) are dropped while reading
+# only meals of days (and thus canteens) contained in our cleaned data are kept, the filter is applied to every range right after parsing
+# XXX: IDs are read and kept as integers because they are much smaller than Python objects (see storage.SCHEMAS)
+meals_columns = [col for col in raw_tables.raw_columns("meals") if col not in ["description", "pos"]]
+meals_table, raw_row_count = raw_tables.read_raw_table("meals", columns=meals_columns,
+                                                       filter=pc.field("day_id").isin(analysis_days_set.to_numpy()))
+german_university_meals = meals_table.to_pandas()
+del meals_table
 
 # rename ID, name, description etc (for differentiation once merged with other CSVs)
 # easiest to just append "meal" to everything, except day_id to avoid confusion
-meals_df = meals_df.add_prefix(prefix="meal_")
-meals_df = meals_df.rename(columns={"meal_day_id": "day_id"})
-print(f"New column headers: {meals_df.columns}")
-
-# delete empty, identical or unneeded columns (they don't contain any valuable information)
-meals_df = meals_df.drop(labels=["meal_description", "meal_pos"], axis="columns")
-print(f"Column headers after deleting unneeded features: {meals_df.columns}")
+german_university_meals = german_university_meals.add_prefix(prefix="meal_")
+german_university_meals = german_university_meals.rename(columns={"meal_day_id": "day_id"})
 
-# adjust data types where necessary for more convenience when working with the data
-print("Old datatypes of meals_df are:")
-print(meals_df.dtypes)
+# now merge with days_df -> this time we will use an inner join, because we only want to keep the meals that belong to canteens contained in our pre-filtered canteens_df
+# canteen features are not merged, they would be repeated on every meal -> just keep meals of our canteens
+german_university_meals = pd.merge(left=german_university_meals, right=days_df, how="inner", left_on="day_id", right_index=True)
+german_university_meals = german_university_meals[german_university_meals["canteen_id"].isin(canteen_df.index)]
 
-meals_df["meal_id"] = meals_df["meal_id"].astype("object")
-meals_df["meal_created_at"] = pd.to_datetime(meals_df["meal_created_at"], format="%Y-%m-%d %H:%M:%S.%f")
-meals_df["meal_updated_at"] = pd.to_datetime(meals_df["meal_updated_at"], format="%Y-%m-%d %H:%M:%S.%f")
-meals_df["day_id"] = meals_df["day_id"].astype("object")
+# ATTENTION: parse timestamps only after filtering, most rows of the dump are discarded anyways
+german_university_meals["meal_created_at"] = pd.to_datetime(german_university_meals["meal_created_at"], format="%Y-%m-%d %H:%M:%S.%f")
+german_university_meals["meal_updated_at"] = pd.to_datetime(german_university_meals["meal_updated_at"], format="%Y-%m-%d %H:%M:%S.%f")
 
-print("New datatypes of meals_df are:")
-print(meals_df.dtypes)
+# XXX: we end up with about 4,400,000 data points
+german_university_meals = german_university_meals.reset_index(drop=True)
 
-# check if ID is unique, if it is, assign as index
-meal_stats = meals_df.describe(include="all", datetime_is_numeric=True)
-meals_df = meals_df.set_index(keys="meal_id")
+# check if parsing worked correctly
+print(german_university_meals.head())
+print(f"Rows read from meals.csv: {raw_row_count}")
+print(f"Shape after filtering on analysis canteens and days: {german_university_meals.shape}")
 
 #######################################################
-# FILTER ACCORDING TO NEEDED CANTEENS AND DAYS
+# THE BASICS: COLUMN NAMES, COLUMNS NEEDED, DATA TYPES, INDEX
 #######################################################
 
-# to reduce the amount of data we are working with (execution time, complexity, etc.), filter data based on cleaned canteens.csv and days.csv
-# so first of all, load cleaned data
-canteen_df = pd.read_pickle("data/processed_data/canteens_cleaned.pkl")
-days_df = pd.read_pickle("data/processed_data/days_cleaned.pkl")
+# check columns (renaming and dropping of unneeded features was already done while reading)
+print(f"Column headers: {german_university_meals.columns}")
 
-# now merge with meals_df -> this time we will use an inner join, because we only want to keep the meals that belong to canteens contained in our pre-filtered canteens_df
-# XXX: we end up with about 4,400,000 data points
-german_university_meals = pd.merge(left=meals_df, right=days_df, how="inner", left_on="day_id", right_index=True)
-german_university_meals = pd.merge(left=german_university_meals, right=canteen_df, how="inner", left_on="canteen_id", right_index=True)
+
+print("New datatypes of meals_df are:")
+print(german_university_meals.dtypes)
+
+# check if ID is unique, if it is, assign as index
+meal_stats = german_university_meals.describe(include="all", datetime_is_numeric=True)
+german_university_meals = german_university_meals.set_index(keys="meal_id")
 
 #######################################################
 # REMOVE DUPLICATES
@@ -77,11 +90,11 @@ german_university_meals = pd.merge(left=german_university_meals, right=canteen_d
 
 # we'll consider the set of meal_name, meal_category, canteen_id, date_correct necessary to uniquely identify a meal
 # meal_category because sometimes the same meal is offered in different menu lines
-duplicates = german_university_meals[german_university_meals.duplicated(subset=['meal_name', 'meal_category', 'canteen_id', 'date_correct'], keep=False)]
-print(f"Number of identical meals: {duplicates.shape[0]}")
+# keys are hashed once into 64-bit fingerprints, number of duplicates and first occurrences come from the same pass (see dedup.py)
+duplicate_count, mask = dedup.find_duplicates(german_university_meals, subset=['meal_name', 'meal_category', 'canteen_id', 'date_correct'])
+print(f"Number of identical meals: {duplicate_count}")
 
 # for practical reasons I will only keep the first occurence of all duplicates
-mask = german_university_meals.duplicated(subset=['meal_name', 'meal_category', 'canteen_id', 'date_correct'], keep="first")
 german_university_meals = german_university_meals[~mask]
 
 #######################################################
@@ -113,28 +126,23 @@ name_categories["cum_percent"] = name_categories["cum_sum"] / german_university_
     # "Ausgabe geschlossen, bitte besuchen Sie für dieses Angebot unsere Ausgabe im 2.OG: LON XOT CA CHUA - Schweinefleisch mit buntem Wokgemüse, dazu Thaireis"
     # "Ausgabe geschlossen, bitte besuchen Sie für dieses Angebot unsere Ausgabe im 2. OG: GA T XAO CARI DO - Zartes Putenfleisch mit buntem Wokgemüse, dazu Reisnudeln"
     # "Ausgabe geschlossen, bitte besuchen Sie für dieses Angebot unsere Ausgabe im 2. OG: GA HUONG CAM - Zartes Hähnchenfleisch mit buntem Wokgemüse, dazu Basmati Reis"
-closed = german_university_meals[german_university_meals["meal_name"].str.contains(pat="geschlossen|entfällt|kein", case=False, regex=True)]
-closed_categories = closed["meal_name"].value_counts(dropna=False).to_frame(name="count").reset_index()
-
-# un-mark the "real" meals accidentally caught in closed filter
-# delete the remaining meals
-closed = closed[~closed["meal_name"].str.contains("Rezeptur|kein Käse|Schaschlik|keine Beilage|mensaVital|Hend'l|Bowl|Pizza-Point|Pasta-Strecke|Seelachsfilet|Hartkäse|Wokgemüse", case=False, regex=True)]
-german_university_meals = german_university_meals.drop(index=closed.index)
 
-# filter meals with name "." or "--" -> we can't use str.contains because these characters also appear in a lot of real meals
-# we'll filter for any entries that contain just a repetition of special characters (and nothing else) -> regex for convenient approach
-closed = german_university_meals[german_university_meals["meal_name"].str.fullmatch(pat=r"\W+")]
-closed_categories = closed["meal_name"].value_counts(dropna=False).to_frame(name="count").reset_index()
-german_university_meals = german_university_meals.drop(index=closed.index)
+# all filters are declared as rules and evaluated together in one pass over the distinct meal names (see rule_engine.py)
+# instead of inspecting value_counts of every filter, check the hit report (meals, distinct names and most common names per rule)
+non_meal_rules = RuleSet([
+    # un-mark the "real" meals accidentally caught in closed filter
+    Rule("closed", include="geschlossen|entfällt|kein", exclude="Rezeptur|kein Käse|Schaschlik|keine Beilage|mensaVital|Hend'l|Bowl|Pizza-Point|Pasta-Strecke|Seelachsfilet|Hartkäse|Wokgemüse"),
+    # filter meals with name "." or "--" -> we can't use str.contains because these characters also appear in a lot of real meals
+    # we'll filter for any entries that contain just a repetition of special characters (and nothing else) -> regex for convenient approach
+    Rule("special_characters", include=r"\W+", mode="fullmatch", case=True),
+    # filter for other announcements, exclude salad dishes
+    Rule("announcements", include="aufgrund|wir |gäste", exclude="salat")])
 
-# filter for other announcements, exclude salad dishes
-announcements = german_university_meals[german_university_meals["meal_name"].str.contains(pat="aufgrund|wir |gäste", case=False, regex=True)]
-announcements_categories = announcements["meal_name"].value_counts().to_frame().reset_index()
-announcements = announcements[~announcements["meal_name"].str.contains(pat="salat", case=False, regex=True)]
-announcements_categories = announcements["meal_name"].value_counts().to_frame().reset_index()
+non_meals, non_meal_report = non_meal_rules.apply(german_university_meals["meal_name"])
+print(non_meal_report)
 
-# delete annoucnements
-german_university_meals = german_university_meals.drop(index=announcements.index)
+# delete closed canteens and announcements
+german_university_meals = german_university_meals[~non_meals]
 
 #######################################################
 # REMOVE WRONGLY-PARSED DATA
@@ -142,9 +150,13 @@ german_university_meals = german_university_meals.drop(index=announcements.index
 
 # some data points were parsed incorrectly, probably due to special characters being misread etc.
 # we will remove them for now, because cleaning them would take too much  effort
-sus_meal_categories = german_university_meals[(german_university_meals["meal_category"].str.len() > 50) & (~german_university_meals["meal_category"].str.contains(pat="theke|heute|menü|flex-gericht|mittagsgericht|restaurant|to-go|EG Süd|pro Portion|Ausgabe|Cafeteria|delicious|foodhopper", case=False, regex=True))]
+# categories are only checked once per distinct category (see distinct.py), meals without category are never suspicious
+is_sus_category = map_distinct(german_university_meals["meal_category"],
+                               lambda categories: (categories.str.len() > 50) & (~categories.str.contains(pat="theke|heute|menü|flex-gericht|mittagsgericht|restaurant|to-go|EG Süd|pro Portion|Ausgabe|Cafeteria|delicious|foodhopper", case=False, regex=True)),
+                               na_result=False)
+sus_meal_categories = german_university_meals[is_sus_category]
 sus_meal_categories_counts = sus_meal_categories["meal_category"].value_counts(dropna=False).to_frame(name="count").reset_index()
-print(sus_meal_categories["canteen_name"].value_counts())
+print(canteen_df.loc[sus_meal_categories["canteen_id"], "canteen_name"].value_counts())
 
 # delete entries which were parsed wrongly
 german_university_meals = german_university_meals.drop(index=sus_meal_categories.index)
@@ -210,9 +222,12 @@ lookup = lookup["meal_name"].value_counts(dropna=False)
 super_categories = pd.read_csv("data/helper_data/analysis_subset_meal_categories_with_counts_sorted.csv", sep=",", usecols=[1, 5])
 super_categories = super_categories.fillna(value="unmatched")
 
-# now merge, set index first, because otherwise we would join feature on feature and lose index of german_university_meals
+# now look up super category of every distinct category instead of merging all meals (see distinct.py)
+# ATTENTION: missing categories are looked up as well, they can have a super category just like every other category (same as merge before)
 super_categories = super_categories.set_index("index")
-german_university_meals = pd.merge(left=german_university_meals, right=super_categories, how="left", left_on="meal_category", right_index=True)
+german_university_meals["meal_super_category"] = map_distinct(german_university_meals["meal_category"],
+                                                              lambda categories: super_categories["meal_super_category"].reindex(categories).to_numpy(),
+                                                              skip_na=False)
 
 # distribution of derived feature
 dish_type_distribution = german_university_meals["meal_super_category"].value_counts(dropna=False).to_frame(name="count")
@@ -228,10 +243,8 @@ german_university_meals = german_university_meals[(german_university_meals["meal
 # SELECT NEEDED FEATURES AND SAVE
 #######################################################
 
-# canteen_replaced_by is completely empty for our data selection, so we can drop it
-# metadata about data creation is probably not relevant either, but we will keep it for now
+# metadata about data creation is probably not relevant, but we will keep it for now
 # our auxiliary feature to_be_deleted, time_difference and price_missing / price_range we can probably drop because we won't need them anymore
-german_university_meals = german_university_meals.drop(columns=["canteen_replaced_by"])
 
-# now save
-german_university_meals.to_pickle("data/processed_data/meals_cleaned.pkl")
+# now save -> IDs are saved as integers and categories as categoricals (see storage.SCHEMAS)
+storage.write_table(german_university_meals, "meals_cleaned")
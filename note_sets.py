@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Nov 28 09:14:51 2023
+
+@author: Tuni
+"""
+
+# this file contains the compact representation of the notes of every meal
+# instead of joining note names into one string per meal (and searching substrings later on), the note IDs of all meals are kept
+# in compressed sparse row (CSR) format: one integer array with all note IDs, ordered by meal, and the offsets where each meal starts
+# questions like "has this meal any of these notes?" then become a vectorized lookup over integers
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import storage
+
+
+class NoteSets:
+
+    # meal_ids: pd.Index of meals (order of the meals in the CSR)
+    # indptr: offsets, note IDs of the meal at position i are note_ids[indptr[i]:indptr[i + 1]]
+    def __init__(self, meal_ids, indptr, note_ids):
+        self.meal_ids = meal_ids
+        self.indptr = indptr
+        self.note_ids = note_ids
+
+    # build note sets from (meal_id, note_id) pairs (e.g., meals_notes.csv)
+    # pairs of meals not contained in meal_ids are dropped, meals without pairs get an empty note set
+    # ATTENTION: order of notes within a meal is kept (stable sort), so joined note lists look the same as before
+    @classmethod
+    def from_pairs(cls, meal_ids, pair_meal_ids, pair_note_ids):
+        meal_ids = pd.Index(meal_ids)
+        positions = meal_ids.get_indexer(pair_meal_ids)
+        known = positions >= 0
+        positions = positions[known]
+        note_ids = np.asarray(pair_note_ids)[known]
+
+        order = np.argsort(positions, kind="stable")
+        indptr = np.zeros(len(meal_ids) + 1, dtype="int64")
+        np.cumsum(np.bincount(positions, minlength=len(meal_ids)), out=indptr[1:])
+        return cls(meal_ids, indptr, note_ids[order].astype("int32"))
+
+    def __len__(self):
+        return len(self.meal_ids)
+
+    # number of notes per meal (same as notes_count)
+    def counts(self):
+        return pd.Series(np.diff(self.indptr), index=self.meal_ids)
+
+    # number of hits per meal, hits: boolean array with one entry per stored note ID
+    def _count_per_meal(self, hits):
+        cumulative = np.zeros(len(hits) + 1, dtype="int64")
+        np.cumsum(hits, out=cumulative[1:])
+        return cumulative[self.indptr[1:]] - cumulative[self.indptr[:-1]]
+
+    # check for every meal if it has at least one of the given note IDs, returns boolean series indexed by meal_id
+    def has_any(self, note_ids):
+        hits = np.isin(self.note_ids, np.asarray(list(note_ids), dtype="int32"))
+        return pd.Series(self._count_per_meal(hits) > 0, index=self.meal_ids)
+
+    # note sets that only contain the given note IDs (e.g., the 90% most common notes)
+    def subset(self, note_ids):
+        keep = np.isin(self.note_ids, np.asarray(list(note_ids), dtype="int32"))
+        indptr = np.zeros(len(self.meal_ids) + 1, dtype="int64")
+        np.cumsum(self._count_per_meal(keep), out=indptr[1:])
+        return NoteSets(self.meal_ids, indptr, self.note_ids[keep])
+
+    # join the note names of every meal into one string (notes_list) and count the notes with a name (notes_count)
+    # note_names: series of note names indexed by note ID, notes without name and meals without notes get the placeholder missing
+    # replaces groupby().agg(lambda col: ";".join(col)): names are looked up by array indexing and joined in one Arrow call
+    def note_lists(self, note_names, separator=";", missing="N/A"):
+        # ATTENTION: get_indexer returns -1 for unknown note IDs, which selects the placeholder appended to the names
+        positions = pd.Index(note_names.index).get_indexer(self.note_ids).astype("int32")
+        names = pa.array(list(note_names.fillna(missing)) + [missing], type=pa.string())
+        note_values = pa.DictionaryArray.from_arrays(pa.array(np.where(positions < 0, len(names) - 1, positions).astype("int32")), names)
+
+        lists = pa.LargeListArray.from_arrays(pa.array(self.indptr), note_values.cast(pa.string()))
+        joined = pc.binary_join(lists, separator).to_numpy(zero_copy_only=False)
+        joined[np.diff(self.indptr) == 0] = missing
+
+        counts = self._count_per_meal(np.append(note_names.notna().to_numpy(), False)[positions])
+        return pd.DataFrame({"notes_list": joined, "notes_count": counts}, index=self.meal_ids)
+
+    # long format (one row per meal and note) for saving
+    def to_frame(self):
+        return pd.DataFrame({"meal_id": np.repeat(self.meal_ids.to_numpy(), np.diff(self.indptr)),
+                             "note_id": self.note_ids})
+
+
+# save note sets of meals and the note vocabulary (note_id -> notes_name, is_common) next to the meal tables
+def write_note_sets(note_sets, vocabulary_df, base_dir=storage.PROCESSED_DATA_DIR):
+    storage.write_table(note_sets.to_frame(), "meal_notes", base_dir=base_dir)
+    storage.write_table(vocabulary_df, "notes_vocabulary", base_dir=base_dir)
+
+
+# load note sets of the given meals, common_only: only keep the 90% most common notes (same notes as notes_list_90)
+def load_note_sets(meal_ids, common_only=False, base_dir=storage.PROCESSED_DATA_DIR):
+    pairs = storage.read_table("meal_notes", base_dir=base_dir)
+    note_sets = NoteSets.from_pairs(meal_ids, pairs["meal_id"].to_numpy(), pairs["note_id"].to_numpy())
+    if common_only:
+        vocabulary_df = load_vocabulary(base_dir)
+        note_sets = note_sets.subset(vocabulary_df.index[vocabulary_df["is_common"]])
+    return note_sets
+
+
+# note vocabulary indexed by note_id
+def load_vocabulary(base_dir=storage.PROCESSED_DATA_DIR):
+    return storage.read_table("notes_vocabulary", base_dir=base_dir)
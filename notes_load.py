@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Dec 15 09:12:40 2023
+
+@author: Tuni
+"""
+
+# this file loads notes.csv and meals_notes.csv for notes_cleanup.py
+# loading, typing and deduplicating the notes doesn't depend on the cleaned meals, so it is its own pipeline stage that can run at the
+# same time as the canteens, days and meals cleanup (see pipeline.py) -> notes_cleanup.py only needs to do the join with the meals
+
+import pandas as pd
+
+import raw_tables
+import storage
+
+pd.set_option("display.max_columns", None)
+pd.set_option("display.max_rows", None)
+
+#######################################################
+# READ IN DATA
+#######################################################
+
+# read in notes.csv (parsed in parallel, see raw_tables.py), then parse the timestamps (3rd and 4th column)
+notes_df = raw_tables.read_raw_table("notes")[0].to_pandas()
+for col in notes_df.columns[2:4]:
+    notes_df[col] = pd.to_datetime(notes_df[col])
+
+# to match notes and meals, we need to use auxiliary df meals_notes.csv
+mapper_df = raw_tables.read_raw_table("meals_notes")[0].to_pandas()
+
+
+# check if everything worked correctly using head() -> too much data to use interactive explorer
+print("Let's take a first glance at our data to check for reading errors and what we are dealing with")
+print(notes_df.head())
+
+print("Let's take a first glance at our data to check for reading errors and what we are dealing with")
+print(mapper_df.tail())
+
+#######################################################
+# THE BASICS: COLUMNS, ROWS, DATA TYPES
+#######################################################
+
+#  add "notes_" to all headers to avoid confusion
+print(f"Dataset notes.csv has shape: {notes_df.shape}")
+print(f"Column headers of notes.csv: {notes_df.columns}")
+notes_df = notes_df.add_prefix(prefix="notes_")
+
+# same for mapper_df (but we just have one column to rename, "id")
+print(f"Dataset meals_notes.csv has shape: {mapper_df.shape}")
+print(f"Column headers of meals_notes.csv: {mapper_df.columns}")
+mapper_df = mapper_df.rename(columns={"id": "mapper_id"})
+
+# adjust mapper_df and notes_df data types to allow for easier data manipulation later on
+# ATTENTION: keep IDs as integers, all joins below are lookups on integer keys
+print("datatypes of notes_df are:")
+print(notes_df.dtypes)
+notes_df["notes_id"] = notes_df["notes_id"].astype("int64")
+print("datatypes of notes_df (NEW) are:")
+print(notes_df.dtypes)
+
+print("datatypes of meals_notes.csv are:")
+print(mapper_df.dtypes)
+mapper_df = mapper_df.astype("int64")
+print("datatypes of meals_notes.csv (NEW) are:")
+print(mapper_df.dtypes)
+
+
+# set indices to work with more convenience with data
+mapper_df = mapper_df.set_index(keys="mapper_id")
+notes_df = notes_df.set_index(keys="notes_id")
+
+#######################################################
+# DUPLICATES
+#######################################################
+
+# only mapper_df contains duplicates, we will remove them except first occurrence
+# XXX: ATTENTION: index should not be included in duplicates check
+duplicates = mapper_df[mapper_df.duplicated(keep=False)]
+print(f"Number of duplicates contained in mapper_df: {duplicates.shape[0]}")
+
+# now delete -> ATTENTION: use setting keep="first" to retain one record of each duplicate group
+mapper_df = mapper_df[~mapper_df.duplicated(keep="first")]
+
+#######################################################
+# SAVE
+#######################################################
+
+storage.write_table(notes_df, "notes_loaded")
+storage.write_table(mapper_df, "notes_mapper")
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Dec 14 10:26:03 2023
+
+@author: Tuni
+"""
+
+# this file contains the pipeline runner of the cleanup scripts
+# the scripts form a DAG: canteens_cleanup -> days_cleanup -> meals_cleanup -> notes_cleanup -> extract_metrics / dashboard_snapshot,
+# notes_load runs next to the canteens, days and meals cleanup and the exploration scripts form their own branch
+# every stage declares the files it reads (raw CSVs, helper files), the stages it builds on and the files it writes
+# outputs are cached under a content hash of everything a stage depends on: its inputs, its code (the script + all local modules it imports)
+# and the hashes of its upstream stages -> a stage only reruns if one of these changed, e.g. editing a regex in meals_cleanup.py reruns
+# meals_cleanup and everything after it, while canteens_cleanup and days_cleanup are restored from the cache (or skipped if up to date)
+# stages that don't depend on each other run at the same time (each in its own Python process, up to --workers at once), among the stages
+# that are ready the one with the longest chain of (estimated) work behind it is started first, so the slowest path through the DAG starts early
+# usage (from the repository root): python pipeline.py [stage ...] [--all] [--force] [--workers N] [--verbose]
+
+import argparse
+import ast
+import collections
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# location of the stage cache, relative to the repository root (scripts are run from there)
+CACHE_DIR = "data/cache"
+
+# cached runs kept per stage, older ones are deleted
+CACHE_ENTRIES_PER_STAGE = 3
+
+# bytes read at once while hashing files
+HASH_BLOCK_BYTES = 16 * 1024**2
+
+# shapefile of the country borders used in canteens_cleanup.py and canteens_exploration.py (consists of several files)
+SHAPEFILE = "data/helper_data/ne_50m_admin_0_sovereignty"
+
+# estimated run time of a stage that never ran: one second plus this per MB of input (only used to decide which stage to start first)
+SECONDS_PER_INPUT_MB = 0.05
+
+# lines of a stage's output kept for the error message if it fails
+LOG_TAIL_LINES = 100
+
+# stages of the pipeline
+# script: script that is run, inputs: files and folders read by the script that aren't written by another stage
+# upstream: stages whose outputs are read by the script, outputs: files and folders written by the script
+STAGES = {"canteens_cleanup": {"script": "canteens_cleanup.py",
+                               "inputs": ["data/raw_data/canteens.csv", "data/helper_data/Mensen_Kantinen_final.xlsx"] + [SHAPEFILE + ext for ext in [".shp", ".shx", ".dbf", ".prj", ".cpg"]],
+                               "upstream": [],
+                               "outputs": ["data/processed_data/canteens_cleaned", "maps/canteen_map_cleanup.html"]},
+          "days_cleanup": {"script": "days_cleanup.py",
+                           "inputs": ["data/raw_data/days.csv"],
+                           "upstream": ["canteens_cleanup"],
+                           "outputs": ["data/processed_data/days_cleaned"]},
+          "meals_cleanup": {"script": "meals_cleanup.py",
+                            "inputs": ["data/raw_data/meals.csv", "data/helper_data/analysis_subset_meal_categories_with_counts_sorted.csv"],
+                            "upstream": ["canteens_cleanup", "days_cleanup"],
+                            "outputs": ["data/processed_data/meals_cleaned", "data/helper_data/analysis_subset_meal_categories_with_counts.csv"]},
+          "notes_load": {"script": "notes_load.py",
+                         "inputs": ["data/raw_data/notes.csv", "data/raw_data/meals_notes.csv"],
+                         "upstream": [],
+                         "outputs": ["data/processed_data/notes_loaded", "data/processed_data/notes_mapper"]},
+          "notes_cleanup": {"script": "notes_cleanup.py",
+                            "inputs": [],
+                            "upstream": ["meals_cleanup", "notes_load"],
+                            "outputs": ["data/processed_data/meal_facts", "data/processed_data/dim_calendar", "data/processed_data/dim_categories",
+                                        "data/processed_data/meal_notes", "data/processed_data/notes_vocabulary",
+                                        "data/helper_data/analysis_subset_notes_categories_with_counts.csv"]},
+          # ATTENTION: the query API reads the schema of all dimensions (including canteens and days), see star_schema.query_meals
+          "extract_metrics": {"script": "extract_metrics.py",
+                              "inputs": [],
+                              "upstream": ["canteens_cleanup", "days_cleanup", "notes_cleanup"],
+                              "outputs": ["data/indicators"]},
+          "dashboard_snapshot": {"script": "dashboard_snapshot.py",
+                                 "inputs": [],
+                                 "upstream": ["canteens_cleanup", "days_cleanup", "notes_cleanup"],
+                                 "outputs": ["data/processed_data/dashboard_canteens.arrow", "data/processed_data/dashboard_meals.arrow"]},
+          # exploration scripts: only run on request (see DEFAULT_TARGETS), they write the edited CSVs the later explorations read
+          "canteens_exploration": {"script": "canteens_exploration.py",
+                                   "inputs": ["data/raw_data/canteens.csv"] + [SHAPEFILE + ext for ext in [".shp", ".shx", ".dbf", ".prj", ".cpg"]],
+                                   "upstream": [],
+                                   "outputs": ["maps/canteen_map_simple.html", "maps/canteen_map_organizations.html", "data/raw_data/canteens_edited.csv"]},
+          "days_exploration": {"script": "days_exploration.py",
+                               "inputs": ["data/raw_data/days.csv"],
+                               "upstream": [],
+                               "outputs": ["data/raw_data/days_edited.csv"]},
+          "meals_exploration": {"script": "meals_exploration.py",
+                                "inputs": ["data/raw_data/meals.csv"],
+                                "upstream": ["canteens_exploration", "days_exploration"],
+                                "outputs": ["data/raw_data/meals_edited.csv"]},
+          "notes_exploration": {"script": "notes_exploration.py",
+                                "inputs": ["data/raw_data/notes.csv", "data/raw_data/meals_notes.csv"],
+                                "upstream": ["meals_exploration"],
+                                "outputs": []}}
+
+# stages brought up to date if no stages are given (and their upstream stages)
+DEFAULT_TARGETS = ["extract_metrics", "dashboard_snapshot"]
+
+
+####################################################################
+# HASHES
+####################################################################
+
+# hashes of big files are remembered by (size, modification time), so unchanged raw CSVs aren't read again on every run
+_file_hashes_path = os.path.join(CACHE_DIR, "file_hashes.json")
+
+
+def _load_file_hashes():
+    if not os.path.exists(_file_hashes_path):
+        return {}
+    with open(_file_hashes_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _save_file_hashes(file_hashes):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = _file_hashes_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(file_hashes, file, indent=1, sort_keys=True)
+    os.replace(temp_path, _file_hashes_path)
+
+
+# content hash of a file (or of all files of a folder), missing files hash to "missing"
+def hash_path(path, file_hashes):
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).replace("\\", "/").encode())
+                digest.update(hash_path(file_path, file_hashes).encode())
+        return digest.hexdigest()
+    if not os.path.exists(path):
+        return "missing"
+
+    stat = os.stat(path)
+    known = file_hashes.get(path)
+    if known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known["hash"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_BYTES), b""):
+            digest.update(block)
+    file_hashes[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest.hexdigest()}
+    return file_hashes[path]["hash"]
+
+
+# local modules a script depends on: all modules of the repository root it imports, directly or through other local modules
+def code_files(script):
+    files, pending = [], [script]
+    while pending:
+        path = pending.pop()
+        if path in files:
+            continue
+        files.append(path)
+
+        with open(path, "r", encoding="utf-8") as file:
+            tree = ast.parse(file.read(), filename=path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                modules = [node.module]
+            else:
+                continue
+            for module in modules:
+                module_path = module.split(".")[0] + ".py"
+                if os.path.exists(module_path):
+                    pending.append(module_path)
+    return sorted(files)
+
+
+# cache key of the given stages (and their upstream stages): hash of their code, their inputs and the keys of their upstream stages
+# upstream outputs are fully determined by the upstream keys, so they don't need to be hashed themselves
+def stage_keys(names, stages=STAGES):
+    file_hashes = _load_file_hashes()
+    keys = {}
+    for name in required_stages(names, stages):
+        stage = stages[name]
+        digest = hashlib.sha256(name.encode())
+        for path in code_files(stage["script"]):
+            digest.update(f"code:{path}:{hash_path(path, file_hashes)}".encode())
+        for path in stage["inputs"]:
+            digest.update(f"input:{path}:{hash_path(path, file_hashes)}".encode())
+        for upstream in stage["upstream"]:
+            digest.update(f"upstream:{upstream}:{keys[upstream]}".encode())
+        keys[name] = digest.hexdigest()
+    _save_file_hashes(file_hashes)
+    return keys
+
+
+####################################################################
+# DAG
+####################################################################
+
+# stages in an order in which every stage comes after its upstream stages
+def topological_order(stages=STAGES):
+    order, visiting = [], set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Stage '{name}' depends on itself")
+        visiting.add(name)
+        for upstream in stages[name]["upstream"]:
+            visit(upstream)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+# targets and all stages they (indirectly) depend on
+def required_stages(targets, stages=STAGES):
+    required, pending = set(), list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in stages:
+            raise ValueError(f"Unknown stage '{name}'")
+        if name not in required:
+            required.add(name)
+            pending += stages[name]["upstream"]
+    return [name for name in topological_order(stages) if name in required]
+
+
+# stages that directly build on each of the given stages
+def downstream_stages(names, stages=STAGES):
+    downstream = {name: [] for name in names}
+    for name in names:
+        for upstream in stages[name]["upstream"]:
+            downstream[upstream].append(name)
+    return downstream
+
+
+####################################################################
+# CACHE
+####################################################################
+
+def _entry_dir(name, key):
+    return os.path.join(CACHE_DIR, name, key)
+
+
+# key of the outputs that are currently in place (written by the last run or restore of the stage)
+def _current_key_path(name):
+    return os.path.join(CACHE_DIR, name, "current")
+
+
+def _read_current_key(name):
+    path = _current_key_path(name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return file.read().strip()
+
+
+def _write_current_key(name, key):
+    os.makedirs(os.path.join(CACHE_DIR, name), exist_ok=True)
+    with open(_current_key_path(name), "w", encoding="utf-8") as file:
+        file.write(key)
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _copy(source, destination):
+    _remove(destination)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination)
+    else:
+        os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+        shutil.copy2(source, destination)
+
+
+# copy the outputs of a stage into its cache entry
+# ATTENTION: outputs are copied (not linked), scripts overwrite some outputs in place (e.g., to_csv) and would change the cache otherwise
+def _store(name, key, stages=STAGES):
+    entry = _entry_dir(name, key)
+    temp_entry = entry + ".tmp"
+    _remove(temp_entry)
+    for path in stages[name]["outputs"]:
+        if os.path.exists(path):
+            _copy(path, os.path.join(temp_entry, "outputs", path))
+    os.makedirs(temp_entry, exist_ok=True)
+    with open(os.path.join(temp_entry, "stage.json"), "w", encoding="utf-8") as file:
+        json.dump({"stage": name, "key": key, "created": time.strftime("%Y-%m-%d %H:%M:%S"), "outputs": stages[name]["outputs"]}, file, indent=1)
+    _remove(entry)
+    os.replace(temp_entry, entry)
+
+    # only keep the newest entries of the stage
+    entries = [_entry_dir(name, other) for other in os.listdir(os.path.join(CACHE_DIR, name)) if os.path.exists(os.path.join(CACHE_DIR, name, other, "stage.json"))]
+    for old_entry in sorted(entries, key=os.path.getmtime, reverse=True)[CACHE_ENTRIES_PER_STAGE:]:
+        shutil.rmtree(old_entry)
+
+
+# copy the cached outputs of a stage back into place
+def _restore(name, key, stages=STAGES):
+    entry = _entry_dir(name, key)
+    for path in stages[name]["outputs"]:
+        cached_path = os.path.join(entry, "outputs", path)
+        if os.path.exists(cached_path):
+            _copy(cached_path, path)
+        else:
+            _remove(path)
+
+
+def _is_cached(name, key):
+    return os.path.exists(os.path.join(_entry_dir(name, key), "stage.json"))
+
+
+####################################################################
+# SCHEDULING
+####################################################################
+
+# run times of the last runs of the stages (in seconds), used to estimate how long a stage will take
+_durations_path = os.path.join(CACHE_DIR, "durations.json")
+
+
+def _load_durations():
+    if not os.path.exists(_durations_path):
+        return {}
+    with open(_durations_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _save_durations(durations):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = _durations_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(durations, file, indent=1, sort_keys=True)
+    os.replace(temp_path, _durations_path)
+
+
+# estimated run time of the stages: 0 if the stage will be taken from the cache, otherwise the run time of its last run
+# stages that never ran are estimated from the size of their inputs
+def estimate_costs(names, keys, force=False, stages=STAGES):
+    durations = _load_durations()
+    costs = {}
+    for name in names:
+        if not force and (_read_current_key(name) == keys[name] or _is_cached(name, keys[name])):
+            costs[name] = 0.0
+        elif name in durations:
+            costs[name] = durations[name]
+        else:
+            input_bytes = sum(os.path.getsize(path) for path in stages[name]["inputs"] if os.path.isfile(path))
+            costs[name] = 1.0 + SECONDS_PER_INPUT_MB * input_bytes / 1024**2
+    return costs
+
+
+# priority of the stages: estimated run time of the stage and of the longest chain of stages that builds on it (critical path)
+# ATTENTION: the stages on the critical path decide how long the whole pipeline takes -> start them first
+def critical_path_priorities(names, costs, stages=STAGES):
+    downstream = downstream_stages(names, stages)
+    priorities = {}
+    for name in reversed(names):
+        priorities[name] = costs[name] + max((priorities[other] for other in downstream[name]), default=0.0)
+    return priorities
+
+
+####################################################################
+# RUN
+####################################################################
+
+# stages run in threads of the main process (each thread waits for the process of its script) -> print whole lines only
+_print_lock = threading.Lock()
+
+
+def _print(line):
+    with _print_lock:
+        print(line, flush=True)
+
+
+# run the script of a stage in its own Python process (from the repository root, all paths in the scripts are relative to it)
+# verbose: print the output of the script while it runs (every line prefixed with the stage name)
+# ATTENTION: scripts open matplotlib figures -> use a non-interactive backend, otherwise the run would block
+def run_stage(name, stages=STAGES, verbose=False):
+    env = dict(os.environ, MPLBACKEND="Agg", PYTHONUNBUFFERED="1")
+    tail = collections.deque(maxlen=LOG_TAIL_LINES)
+    with subprocess.Popen([sys.executable, stages[name]["script"]], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+        for raw_line in process.stdout:
+            line = raw_line.decode("utf-8", errors="replace").rstrip()
+            tail.append(line)
+            if verbose:
+                _print(f"[{name}] {line}")
+    if process.returncode != 0:
+        log = "\n".join(tail)
+        raise RuntimeError(f"Stage '{name}' failed with exit code {process.returncode}:\n{log}")
+
+
+# bring the outputs of a stage up to date for the given key
+# returns "up to date" (outputs in place already), "restored" (copied from the cache) or "ran" (script was run and its outputs cached)
+def update_stage(name, key, force=False, stages=STAGES, verbose=False):
+    if not force and _read_current_key(name) == key and all(os.path.exists(path) for path in stages[name]["outputs"]):
+        return "up to date"
+    if not force and _is_cached(name, key):
+        _restore(name, key, stages)
+        _write_current_key(name, key)
+        return "restored"
+
+    # ATTENTION: forget the key of the outputs in place before running, a failed run can leave half-written outputs behind
+    # (e.g., meal_facts written, dim_* tables not) -> these must never count as "up to date" for the old key
+    _remove(_current_key_path(name))
+    run_stage(name, stages, verbose=verbose)
+    _store(name, key, stages)
+    _write_current_key(name, key)
+    return "ran"
+
+
+# run the pipeline up to the targets (None: DEFAULT_TARGETS), force: rerun all required stages regardless of the cache
+# workers: number of stages that run at the same time (None: one per core), verbose: print the output of the scripts
+# a stage is started as soon as all its upstream stages are done, if a stage fails the stages that build on it are skipped,
+# all other stages still run -> a RuntimeError with the errors is raised at the end
+# returns list of (stage, status, seconds) in the order in which the stages finished
+def run_pipeline(targets=None, force=False, workers=None, verbose=False, stages=STAGES):
+    names = required_stages(targets or DEFAULT_TARGETS, stages)
+    keys = stage_keys(names, stages)
+    priorities = critical_path_priorities(names, estimate_costs(names, keys, force, stages), stages)
+    workers = os.cpu_count() if workers is None else workers
+    if workers < 1:
+        raise ValueError(f"At least one worker is needed to run the pipeline, got {workers}")
+
+    statuses, errors, report = {}, {}, []
+    pending, running = set(names), {}
+
+    def finish(name, status, seconds):
+        statuses[name] = status
+        report.append((name, status, seconds))
+        _print(f"{name:<20} {status:<12} {seconds:8.1f} s   [{len(report)}/{len(names)} done]")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            # stages that build on a failed stage can't run (names are in topological order -> skips are passed on in one loop)
+            for name in names:
+                if name in pending and any(statuses.get(upstream) in ["failed", "skipped"] for upstream in stages[name]["upstream"]):
+                    pending.discard(name)
+                    finish(name, "skipped", 0.0)
+
+            # start the ready stages with the highest priority (stages are only handed to the executor once a worker is free,
+            # so a stage that becomes ready later can still overtake stages with a lower priority)
+            ready = [name for name in names if name in pending and all(upstream in statuses for upstream in stages[name]["upstream"])]
+            for name in sorted(ready, key=lambda name: priorities[name], reverse=True)[:workers - len(running)]:
+                pending.discard(name)
+                running[executor.submit(update_stage, name, keys[name], force, stages, verbose)] = (name, time.perf_counter())
+                _print(f"{name:<20} started")
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, start = running.pop(future)
+                seconds = time.perf_counter() - start
+                # ATTENTION: not only failed scripts (RuntimeError), copying outputs from / into the cache can fail as well (e.g., OSError
+                # if the disk is full) -> catch everything, so that the stages of the other branches are still scheduled
+                try:
+                    status = future.result()
+                except Exception as error:
+                    status = "failed"
+                    errors[name] = error if isinstance(error, RuntimeError) else RuntimeError(f"Stage '{name}' failed: {error!r}")
+                if status == "ran":
+                    durations = _load_durations()
+                    durations[name] = seconds
+                    _save_durations(durations)
+                finish(name, status, seconds)
+
+    if errors:
+        raise RuntimeError("\n\n".join(str(error) for error in errors.values()))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the cleanup pipeline, stages whose inputs and code didn't change are taken from the cache")
+    parser.add_argument("stages", nargs="*", help=f"stages to bring up to date (default: {', '.join(DEFAULT_TARGETS)})")
+    parser.add_argument("--all", action="store_true", help="bring all stages up to date, including the exploration scripts")
+    parser.add_argument("--force", action="store_true", help="rerun the stages even if they are cached")
+    parser.add_argument("--workers", type=int, default=None, help="number of stages that run at the same time (default: one per core)")
+    parser.add_argument("--verbose", action="store_true", help="print the output of the scripts while they run")
+    args = parser.parse_args()
+    run_pipeline(list(STAGES) if args.all else args.stages, force=args.force, workers=args.workers, verbose=args.verbose)
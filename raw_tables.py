@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Dec 13 09:31:44 2023
+
+@author: Tuni
+"""
+
+# this file contains the readers of the raw OpenMensa tables (data/raw_data)
+# the raw tables contain the whole OpenMensa history, but the cleanup scripts only keep the analysis canteens and timeframe
+# -> filters are pushed down into the reader: every CSV is split into byte ranges on line boundaries, the ranges are parsed in parallel
+# (one thread per core, Arrow releases the GIL while parsing) and rows are discarded right after their range is parsed
+# this way all cores are used and peak memory depends on the rows we keep and not on the size of the raw table
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+import date_repair
+
+RAW_DATA_DIR = "data/raw_data"
+
+# size of the byte ranges parsed at once (a few ranges per core are enough to balance the load)
+RANGE_BYTES = 64 * 1024**2
+
+# bytes scanned at once while looking for line boundaries / counting quotes
+SCAN_BYTES = 16 * 1024**2
+
+# raw tables: file and Arrow data types of the features, features that are not listed are read as strings
+# ATTENTION: timestamps are read as strings and parsed by the cleanup scripts after filtering, most rows are discarded anyways
+RAW_TABLES = {"days": {"file": "days.csv",
+                       "types": {"id": pa.int64(), "canteen_id": pa.int64(), "date": pa.string(), "closed": pa.bool_()}},
+              "meals": {"file": "meals.csv",
+                        "types": {"id": pa.int32(), "day_id": pa.int32(), "name": pa.string(), "category": pa.string(),
+                                  "price_student": pa.float64(), "price_employee": pa.float64(), "price_pupil": pa.float64(), "price_other": pa.float64()}},
+              "notes": {"file": "notes.csv",
+                        "types": {"id": pa.int64(), "name": pa.string()}},
+              "meals_notes": {"file": "meals_notes.csv",
+                              "types": {"id": pa.int64(), "meal_id": pa.int64(), "note_id": pa.int64()}}}
+
+
+# path of a raw table
+def raw_path(name, base_dir=RAW_DATA_DIR):
+    return os.path.join(base_dir, RAW_TABLES[name]["file"])
+
+
+# names of all features of a raw table (header of the CSV)
+def raw_columns(name, base_dir=RAW_DATA_DIR):
+    with open(raw_path(name, base_dir), "rb") as file:
+        header = file.readline()
+    return pacsv.read_csv(pa.py_buffer(header)).column_names
+
+
+# find the line boundaries that split the data part of a CSV into ranges of about range_bytes
+# ATTENTION: names can contain line breaks inside quotes -> a line break is only a boundary if the number of quotes before it is even
+def _split_ranges(path, range_bytes):
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    size = data.shape[0]
+    if size == 0:
+        return []
+
+    first_break = np.flatnonzero(data[:SCAN_BYTES] == ord("\n"))
+    data_start = int(first_break[0]) + 1 if len(first_break) else size
+    # ATTENTION: a CSV with only a header has no ranges at all (Arrow refuses to parse an empty range)
+    if data_start >= size:
+        return []
+    targets = range(data_start + range_bytes, size, range_bytes)
+
+    boundaries = [data_start]
+    position, quotes = data_start, 0
+    for target in targets:
+        if target <= boundaries[-1]:
+            continue
+
+        # count quotes up to the target (block by block, so we never hold a mask of the whole file)
+        for block_start in range(position, target, SCAN_BYTES):
+            quotes += int(np.count_nonzero(data[block_start:min(block_start + SCAN_BYTES, target)] == ord('"')))
+        position = target
+
+        # first line break after the target that isn't inside quotes
+        while position < size:
+            window = data[position:position + SCAN_BYTES]
+            window_quotes = quotes + np.cumsum(window == ord('"'))
+            breaks = np.flatnonzero((window == ord("\n")) & (window_quotes % 2 == 0))
+            if len(breaks):
+                boundary = position + int(breaks[0]) + 1
+                quotes = int(window_quotes[breaks[0]])
+                position = boundary
+                break
+            quotes = int(window_quotes[-1])
+            position += window.shape[0]
+        else:
+            break
+        if boundary < size:
+            boundaries.append(boundary)
+
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+# parse one byte range of a CSV and apply the filter and the post filter
+# returns the filtered table and the number of rows before filtering
+def _read_range(path, start, stop, column_names, convert_options, filter, post_filter):
+    with open(path, "rb") as file:
+        file.seek(start)
+        buffer = file.read(stop - start)
+
+    table = pacsv.read_csv(pa.py_buffer(buffer),
+                           read_options=pacsv.ReadOptions(column_names=column_names, use_threads=False),
+                           parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                           convert_options=convert_options)
+    raw_rows = table.num_rows
+    if filter is not None:
+        table = table.filter(filter)
+    if post_filter is not None:
+        table = post_filter(table)
+    return table, raw_rows
+
+
+# read a raw table in parallel
+# columns: only read these features (None: all features), filter: Arrow expression on the read features, e.g. pc.field("day_id").isin(day_ids)
+# post_filter: function applied to the table of every range after filter (e.g., parsing and filtering dates, see read_days), it has to
+# return a table with the same features for every range, None: no post filter
+# threads: number of ranges parsed at the same time (None: one per core)
+# returns (1) Arrow table with the rows that pass the filter (in the order of the CSV) and (2) number of rows of the raw table
+def read_raw_table(name, columns=None, filter=None, post_filter=None, base_dir=RAW_DATA_DIR, threads=None, range_bytes=RANGE_BYTES):
+    path = raw_path(name, base_dir)
+    column_names = raw_columns(name, base_dir)
+    column_types = {col: RAW_TABLES[name]["types"].get(col, pa.string()) for col in column_names}
+
+    # "t"/"f" are read as booleans, empty fields as missing values (same as pandas)
+    convert_options = pacsv.ConvertOptions(column_types=column_types,
+                                           include_columns=columns,
+                                           true_values=["t"], false_values=["f"],
+                                           strings_can_be_null=True)
+
+    ranges = _split_ranges(path, range_bytes)
+    threads = os.cpu_count() if threads is None else threads
+
+    # rows are counted before filtering, so that the scripts can still report how much of the raw table was discarded
+    # ATTENTION: executor.map keeps the order of the ranges -> rows stay in the order of the CSV (needed for keep="first" deduplication)
+    raw_rows = 0
+    tables = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for table, range_rows in executor.map(lambda byte_range: _read_range(path, *byte_range, column_names, convert_options, filter, post_filter), ranges):
+            raw_rows += range_rows
+            tables.append(table)
+
+    if not tables:
+        schema = pa.schema([(col, column_types[col]) for col in (columns or column_names)])
+        empty_table = schema.empty_table()
+        return (empty_table if post_filter is None else post_filter(empty_table)), 0
+    return pa.concat_tables(tables), raw_rows
+
+
+# read days.csv with the dates parsed and repaired (see date_repair.py)
+# canteen_ids: only keep days of these canteens (None: all canteens)
+# start_day, stop_day: only keep days strictly after start_day and strictly before stop_day (day numbers, None: no limit)
+# returns (1) df with the raw features + day_number and date_repaired and (2) report with the number of read, repaired and rejected entries
+# ATTENTION: canteen and timeframe filters are applied on the repaired dates, a repaired entry and the entry it collides with always
+# share canteen and day -> collisions can still be resolved after reading (see date_repair.resolve_collisions)
+def read_days(canteen_ids=None, start_day=None, stop_day=None, base_dir=RAW_DATA_DIR, threads=None):
+    # cheapest filter first: canteen IDs are filtered while parsing
+    canteen_filter = pc.field("canteen_id").isin(np.asarray(canteen_ids, dtype=np.int64)) if canteen_ids is not None else None
+
+    # dates are parsed and the timeframe is applied range by range as well -> only days of the analysis timeframe are kept in memory
+    # ATTENTION: ranges are parsed in threads, list.append is atomic -> counts are collected per range and summed up afterwards
+    rejected_counts = []
+
+    def parse_and_filter_dates(days_table):
+        day_numbers, repaired, valid = date_repair.parse_dates(days_table["date"])
+        keep = valid.copy()
+        if start_day is not None:
+            keep &= day_numbers > start_day
+        if stop_day is not None:
+            keep &= day_numbers < stop_day
+        rejected_counts.append(int((~valid).sum()))
+
+        days_table = days_table.filter(pa.array(keep))
+        days_table = days_table.append_column("day_number", pa.array(day_numbers[keep], type=pa.int32()))
+        return days_table.append_column("date_repaired", pa.array(repaired[keep], type=pa.bool_()))
+
+    days_table, raw_rows = read_raw_table("days", filter=canteen_filter, post_filter=parse_and_filter_dates, base_dir=base_dir, threads=threads)
+    report = {"read": raw_rows,
+              "repaired": int(pc.sum(days_table["date_repaired"]).as_py() or 0),
+              "rejected": sum(rejected_counts)}
+
+    days_df = days_table.to_pandas()
+    days_df["created_at"] = pd.to_datetime(days_df["created_at"])
+    days_df["updated_at"] = pd.to_datetime(days_df["updated_at"])
+    return days_df, report
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Dec  1 09:37:12 2023
+
+@author: Tuni
+"""
+
+# this file contains a small rule engine to filter out meals that aren't meals (closed canteens, announcements, ...)
+# rules are declared once (include pattern + optional exclude pattern for real meals caught by the include pattern)
+# and evaluated together in one pass over the distinct meal names, the verdict of a name is then broadcast to all its meals
+# besides the verdicts, the engine reports how many meals / names each rule hit, so that filters can still be audited
+
+import re
+
+import pandas as pd
+
+from distinct import map_distinct
+
+
+class Rule:
+
+    # name: short name used in the hit report
+    # include: regex, a meal matches the rule if its name contains the pattern (mode="search") or consists of it (mode="fullmatch")
+    # exclude: regex of real meals that are caught by include and need to be un-marked again (always mode="search")
+    # case: case-sensitive matching if True
+    def __init__(self, name, include, exclude=None, mode="search", case=False):
+        if mode not in ["search", "fullmatch"]:
+            raise ValueError(f"Unknown mode '{mode}' of rule '{name}'")
+
+        flags = 0 if case else re.IGNORECASE
+        self.name = name
+        self.include = include
+        self.exclude = exclude
+        self.mode = mode
+        self._include = re.compile(include, flags=flags)
+        self._exclude = re.compile(exclude, flags=flags) if exclude is not None else None
+
+    # check if a single meal name matches the rule
+    def matches(self, text):
+        if self.mode == "fullmatch":
+            matched = self._include.fullmatch(text) is not None
+        else:
+            matched = self._include.search(text) is not None
+        return matched and (self._exclude is None or self._exclude.search(text) is None)
+
+
+class RuleSet:
+
+    def __init__(self, rules):
+        names = [rule.name for rule in rules]
+        if len(set(names)) != len(names):
+            raise ValueError("Rule names need to be unique")
+        self.rules = list(rules)
+
+    # position of the first matching rule of a meal name, -1 if no rule matches
+    def _first_match(self, text):
+        for position, rule in enumerate(self.rules):
+            if rule.matches(text):
+                return position
+        return -1
+
+    # evaluate all rules on a series of meal names
+    # returns (1) boolean mask of the meals matched by any rule and (2) hit report with one row per rule
+    # every meal is attributed to the first rule it matches (same as applying the rules one after another), missing names never match
+    def apply(self, series):
+        # verdict (position of first matching rule) per distinct name, see distinct.py
+        row_rules = map_distinct(series, lambda names: [self._first_match(str(name)) for name in names], na_result=-1)
+
+        report = []
+        for position, rule in enumerate(self.rules):
+            hit_names = series[row_rules == position].value_counts()
+            report.append({"rule": rule.name,
+                           "meals": int(hit_names.sum()),
+                           "distinct_names": hit_names.shape[0],
+                           "top_names": list(hit_names.index[:5])})
+
+        return row_rules >= 0, pd.DataFrame(report)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Dec  6 13:48:20 2023
+
+@author: Tuni
+"""
+
+# this file contains the star schema of the processed data and the query API used by all consumers
+# instead of one wide meal table that contains (and repeats) features of days, canteens, categories and notes, meals are stored as
+# fact table (IDs, keys, prices, flags) and every other feature is stored once in its dimension:
+    # canteens: canteens_cleaned (canteens_cleanup.py), joined by canteen_id
+    # days: days_cleaned (days_cleanup.py), joined by day_id
+    # calendar: dim_calendar (date_correct, year, month, weekday), joined by date_key (days since 1970-01-01)
+    # categories: dim_categories (meal_category -> meal_super_category), joined by category_id
+    # notes: meal_notes + notes_vocabulary (note sets, see note_sets.py), note lists are built when they are requested
+# query_meals() only reads the features that are requested and joins the dimensions they come from
+
+import numpy as np
+import pandas as pd
+
+import meal_flags
+import note_sets
+import storage
+
+# dimensions of the fact table: name -> table, key in fact table (the index of the dimension table is the key in the dimension)
+DIMENSIONS = {"calendar": {"table": "dim_calendar", "key": "date_key"},
+              "categories": {"table": "dim_categories", "key": "category_id"},
+              "canteens": {"table": "canteens_cleaned", "key": "canteen_id"},
+              "days": {"table": "days_cleaned", "key": "day_id"}}
+
+# features built from note sets: feature -> only use the 90% most common notes
+NOTE_LIST_COLUMNS = {"notes_list": False,
+                     "notes_list_90": True}
+
+# features of the fact table besides the keys
+FACT_COLUMNS = ["meal_name", "meal_price_student", "meal_price_employee", "meal_price_pupil", "meal_price_other",
+                "meal_created_at", "meal_updated_at", "notes_count", "notes_count_90",
+                "is_vegetarian", "is_vegan", "contains_whole_grain"]
+
+
+####################################################################
+# BUILD
+####################################################################
+
+# split the cleaned meals (with note counts, see notes_cleanup.py) into fact table and dimensions and save them
+# meal_note_sets: note sets of the meals (all notes), vocabulary_df: note vocabulary (see note_sets.write_note_sets)
+# ATTENTION: canteens and days are already saved by their cleanup scripts, they are only referenced by their keys
+def build_star_schema(meals_df, meal_note_sets, vocabulary_df, base_dir=storage.PROCESSED_DATA_DIR):
+    # calendar: one row per day of the analysis timeframe that has meals
+    date_keys = meals_df["date_correct"].to_numpy().astype("datetime64[D]").astype("int64")
+    calendar_keys = np.unique(date_keys)
+    calendar_dates = pd.DatetimeIndex(calendar_keys.astype("datetime64[D]"))
+    calendar_df = pd.DataFrame({"date_correct": calendar_dates,
+                                "year": calendar_dates.year,
+                                "month": calendar_dates.month,
+                                "weekday": calendar_dates.weekday},
+                               index=pd.Index(calendar_keys, name="date_key"))
+
+    # categories: every category has exactly one super category
+    # ATTENTION: meals without category get their own category_id as well (missing category can still have a super category)
+    category_ids, categories = pd.factorize(meals_df["meal_category"], use_na_sentinel=False)
+    super_categories = pd.Series(meals_df["meal_super_category"].to_numpy(), index=category_ids).groupby(level=0).first()
+    categories_df = pd.DataFrame({"meal_category": np.asarray(categories, dtype=object),
+                                  "meal_super_category": super_categories.reindex(np.arange(len(categories))).to_numpy()},
+                                 index=pd.Index(np.arange(len(categories)), name="category_id"))
+
+    # flags are derived once here, so that consumers don't need to match notes or names again
+    dietary_flags = meal_flags.dietary_flags_by_note_ids(meal_note_sets.subset(vocabulary_df.index[vocabulary_df["is_common"]]), vocabulary_df["notes_name"])
+
+    facts_df = pd.DataFrame({"day_id": meals_df["day_id"].to_numpy(),
+                             "date_key": date_keys,
+                             "canteen_id": meals_df["canteen_id"].to_numpy(),
+                             "category_id": category_ids,
+                             "year": meals_df["date_correct"].dt.year.to_numpy()},
+                            index=meals_df.index)
+    for col in FACT_COLUMNS:
+        if col in meals_df.columns:
+            facts_df[col] = meals_df[col].to_numpy()
+    facts_df["is_vegetarian"] = dietary_flags["is_vegetarian"].to_numpy()
+    facts_df["is_vegan"] = dietary_flags["is_vegan"].to_numpy()
+    facts_df["contains_whole_grain"] = meal_flags.whole_grain_flags(meals_df["meal_name"]).to_numpy()
+
+    storage.write_table(facts_df, "meal_facts", base_dir=base_dir)
+    storage.write_table(calendar_df, "dim_calendar", base_dir=base_dir)
+    storage.write_table(categories_df, "dim_categories", base_dir=base_dir)
+    note_sets.write_note_sets(meal_note_sets, vocabulary_df, base_dir=base_dir)
+
+
+####################################################################
+# QUERY
+####################################################################
+
+# dimension that provides a feature, None if the feature is stored in the fact table or not known at all
+def _find_dimension(column, fact_columns, dimension_columns):
+    if column in fact_columns:
+        return None
+    for dimension, columns in dimension_columns.items():
+        if column in columns:
+            return dimension
+    return None
+
+
+# read meals with the requested features, indexed by meal_id
+# columns: any feature of the fact table, its dimensions or the note lists (notes_list, notes_list_90)
+# filters: filters on features of the fact table (e.g., [("year", ">=", 2020), ("canteen_id", "in", [1, 24])]), see storage.read_table
+# only the requested features are read, dimensions are only read (and joined) if one of their features is requested
+def query_meals(columns, filters=None, base_dir=storage.PROCESSED_DATA_DIR):
+    fact_columns = storage.table_columns("meal_facts", base_dir=base_dir)
+    dimension_columns = {dimension: storage.table_columns(info["table"], base_dir=base_dir) for dimension, info in DIMENSIONS.items()}
+
+    unknown = [col for col in columns if col not in fact_columns and col not in NOTE_LIST_COLUMNS and _find_dimension(col, fact_columns, dimension_columns) is None]
+    if unknown:
+        raise ValueError(f"Unknown features {unknown}")
+
+    # features needed per dimension (the key of a dimension is read from the fact table)
+    needed_dimensions = {}
+    for col in columns:
+        dimension = _find_dimension(col, fact_columns, dimension_columns)
+        if dimension is not None and col not in NOTE_LIST_COLUMNS:
+            needed_dimensions.setdefault(dimension, []).append(col)
+
+    read_columns = [col for col in columns if col in fact_columns] + [DIMENSIONS[dimension]["key"] for dimension in needed_dimensions]
+    meals_df = storage.read_table("meal_facts", columns=list(dict.fromkeys(read_columns)), filters=filters, base_dir=base_dir)
+
+    # lazy joins: only the features requested from each dimension
+    for dimension, dimension_cols in needed_dimensions.items():
+        dimension_df = storage.read_table(DIMENSIONS[dimension]["table"], columns=dimension_cols, base_dir=base_dir)
+        meals_df = meals_df.join(dimension_df[dimension_cols], on=DIMENSIONS[dimension]["key"])
+
+    # note lists are built from the note sets of the selected meals
+    requested_lists = [col for col in columns if col in NOTE_LIST_COLUMNS]
+    if requested_lists:
+        vocabulary_df = note_sets.load_vocabulary(base_dir)
+        all_note_sets = note_sets.load_note_sets(meals_df.index, base_dir=base_dir)
+        for col in requested_lists:
+            meal_note_sets = all_note_sets.subset(vocabulary_df.index[vocabulary_df["is_common"]]) if NOTE_LIST_COLUMNS[col] else all_note_sets
+            meals_df[col] = meal_note_sets.note_lists(vocabulary_df["notes_name"])["notes_list"].astype("category")
+
+    return meals_df[list(columns)]
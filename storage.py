@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Nov 14 10:12:37 2023
+
+@author: Tuni
+"""
+
+# this file contains the storage layer shared by all cleanup scripts, extract_metrics.py and the dashboard
+# instead of handing pickles from stage to stage, every table is saved as a (partitioned) Parquet dataset
+# this way consumers only read the columns (column projection) and the partitions / row groups (predicate pushdown) they actually need
+
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+# default location of the processed tables, relative to the repository root (scripts are run from there)
+# the dashboard is run from its own folder and passes "../data/processed_data" instead
+PROCESSED_DATA_DIR = "data/processed_data"
+
+# location of the indicator store written by extract_metrics.py
+INDICATORS_DIR = "data/indicators"
+
+# every table handed over between pipeline stages
+# index: feature that was used as index of the pickled df -> stored as normal column and set as index again while reading (None: no index)
+# partition_cols: features used for hive-style partitioning (one folder per value) -> "year" is derived from date_correct while writing
+TABLES = {"canteens_cleaned": {"index": "canteen_id", "partition_cols": []},
+          "days_cleaned": {"index": "days_id", "partition_cols": ["year"]},
+          "meals_cleaned": {"index": "meal_id", "partition_cols": ["year", "canteen_id"]},
+          "meal_facts": {"index": "meal_id", "partition_cols": ["year"]},
+          "dim_calendar": {"index": "date_key", "partition_cols": []},
+          "dim_categories": {"index": "category_id", "partition_cols": []},
+          "notes_loaded": {"index": "notes_id", "partition_cols": []},
+          "notes_mapper": {"index": "mapper_id", "partition_cols": []},
+          "meal_notes": {"index": None, "partition_cols": []},
+          "notes_vocabulary": {"index": "note_id", "partition_cols": []},
+          "indicators": {"index": None, "partition_cols": ["year"]},
+          "indicator_fingerprints": {"index": None, "partition_cols": []}}
+
+# data types of the features of every table, applied while writing (features that are not listed keep their data type)
+# IDs are stored as integers, strings with few distinct values as categoricals (-> dictionary encoded in Parquet, categorical again while reading)
+# ATTENTION: canteen features are not repeated on every meal, they are joined from canteens_cleaned by canteen_id (see star_schema.query_meals)
+MEAL_SCHEMA = {"meal_id": "int64",
+               "day_id": "int64",
+               "canteen_id": "int64",
+               "meal_category": "category",
+               "meal_super_category": "category"}
+
+SCHEMAS = {"canteens_cleaned": {"canteen_id": "int64"},
+           "days_cleaned": {"days_id": "int64", "canteen_id": "int64"},
+           "meals_cleaned": MEAL_SCHEMA,
+           "notes_loaded": {"notes_id": "int64"},
+           "notes_mapper": {"mapper_id": "int64", "meal_id": "int64", "note_id": "int64"},
+           "meal_facts": {"meal_id": "int64",
+                          "day_id": "int64",
+                          "date_key": "int32",
+                          "canteen_id": "int64",
+                          "category_id": "int32",
+                          "notes_count": "int16",
+                          "notes_count_90": "int16"},
+           "dim_calendar": {"date_key": "int32", "year": "int16", "month": "int8", "weekday": "int8"},
+           "dim_categories": {"category_id": "int32", "meal_category": "category", "meal_super_category": "category"}}
+
+# data types of the partition features -> otherwise pyarrow has to guess them from the folder names
+PARTITION_TYPES = {"year": pa.int16(),
+                   "canteen_id": pa.int64()}
+
+
+# path of a table's dataset folder
+def table_path(name, base_dir=PROCESSED_DATA_DIR):
+    return os.path.join(base_dir, name)
+
+
+# hive partitioning (folders like "year=2019/canteen_id=24") of a table
+def _partitioning(name):
+    partition_cols = TABLES[name]["partition_cols"]
+    if not partition_cols:
+        return None
+    return ds.partitioning(pa.schema([(col, PARTITION_TYPES[col]) for col in partition_cols]), flavor="hive")
+
+
+# convert df into Arrow table that can be written into the dataset of a table
+def _to_arrow(df, name):
+    table_info = TABLES[name]
+
+    # index is stored as normal column, pyarrow would otherwise keep it only in the pandas metadata
+    if table_info["index"] is not None:
+        df = df.reset_index()
+
+    # apply schema of the table
+    schema = {col: dtype for col, dtype in SCHEMAS.get(name, {}).items() if col in df.columns}
+    df = df.astype(schema)
+
+    # derive partition feature "year" from date_correct if not present yet
+    if "year" in table_info["partition_cols"] and "year" not in df.columns:
+        df["year"] = df["date_correct"].dt.year.astype("int16")
+
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+# write Arrow table into dataset folder
+# existing_data_behavior: "overwrite_or_ignore" for new datasets, "delete_matching" to replace only the partitions contained in table
+def _write_dataset(table, name, path, existing_data_behavior):
+    # strings are dictionary encoded (meal names, categories and canteen features repeat a lot)
+    # ATTENTION: pyarrow refuses to write more than 1024 partitions by default, meals_cleaned has one per canteen and year
+    file_options = ds.ParquetFileFormat().make_write_options(use_dictionary=True, compression="zstd")
+    ds.write_dataset(table, path, format="parquet",
+                     partitioning=_partitioning(name),
+                     file_options=file_options,
+                     max_rows_per_group=256_000,
+                     max_partitions=100_000,
+                     existing_data_behavior=existing_data_behavior)
+
+
+# save a df as Parquet dataset, replaces pickle.to_pickle() in the cleanup scripts
+def write_table(df, name, base_dir=PROCESSED_DATA_DIR):
+    path = table_path(name, base_dir)
+
+    # ATTENTION: remove old dataset first, otherwise partitions that are not contained in the new data would survive
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    _write_dataset(_to_arrow(df, name), name, path, "overwrite_or_ignore")
+
+
+# replace only the partitions contained in df, all other partitions of the dataset stay untouched
+# ATTENTION: df needs to contain all rows of the partitions it touches, rows that are not contained are lost
+def write_partitions(df, name, base_dir=PROCESSED_DATA_DIR):
+    _write_dataset(_to_arrow(df, name), name, table_path(name, base_dir), "delete_matching")
+
+
+# delete whole partitions of a dataset (e.g., years that don't contain any rows anymore)
+# values: values of the (first) partition feature, e.g. [2019, 2020] for folders "year=2019" and "year=2020"
+def delete_partitions(name, values, base_dir=PROCESSED_DATA_DIR):
+    partition_col = TABLES[name]["partition_cols"][0]
+    for value in values:
+        path = os.path.join(table_path(name, base_dir), f"{partition_col}={value}")
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+# check if a table has been written before
+def table_exists(name, base_dir=PROCESSED_DATA_DIR):
+    return os.path.exists(table_path(name, base_dir))
+
+
+# names of all features of a table (including index and partition features) without reading any data
+def table_columns(name, base_dir=PROCESSED_DATA_DIR):
+    return ds.dataset(table_path(name, base_dir), format="parquet", partitioning=_partitioning(name)).schema.names
+
+
+# read a Parquet dataset back into a df
+# columns: only read these features (column projection), index feature is always included
+# filters: list of (feature, operator, value) tuples that are combined with AND, e.g. [("year", ">=", 2020), ("canteen_id", "in", [1, 24])]
+# ATTENTION: filters on partition features skip whole folders, filters on other features skip row groups using Parquet statistics
+def read_table(name, columns=None, filters=None, base_dir=PROCESSED_DATA_DIR):
+    index = TABLES[name]["index"]
+
+    if columns is not None and index is not None and index not in columns:
+        columns = [index] + list(columns)
+
+    table = pq.read_table(table_path(name, base_dir),
+                          columns=columns,
+                          filters=filters,
+                          partitioning=_partitioning(name))
+    df = table.to_pandas()
+
+    if index is None:
+        return df
+    return df.set_index(keys=index)
+
+
+# path of a snapshot file (Arrow IPC / Feather v2 format)
+def snapshot_path(name, base_dir=PROCESSED_DATA_DIR):
+    return os.path.join(base_dir, name + ".arrow")
+
+
+# save a df as uncompressed Arrow IPC file that can be memory-mapped (used for the dashboard)
+# ATTENTION: compressed files can't be memory-mapped, they need to be decompressed into memory while reading
+# write into temporary file first and then replace the snapshot, so running dashboard workers keep their (old) mapping intact
+def write_snapshot(df, name, base_dir=PROCESSED_DATA_DIR):
+    path = snapshot_path(name, base_dir)
+    temp_path = path + ".tmp"
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    feather.write_feather(table, temp_path, compression="uncompressed")
+    os.replace(temp_path, path)
+
+
+# open a snapshot as memory-mapped Arrow table
+# no data is copied while opening: the operating system pages data in when it is accessed and shares these pages between all processes that map the same file
+def open_snapshot(name, base_dir=PROCESSED_DATA_DIR):
+    source = pa.memory_map(snapshot_path(name, base_dir), "r")
+    return pa.ipc.open_file(source).read_all()